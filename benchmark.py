@@ -0,0 +1,919 @@
+#!/usr/bin/env python
+
+"""Benchmark how fast spin starts, reacts to device state and stylus events and
+rotates.
+
+spin is run against a fake acpid socket, a FIFO standing in for the stylus, a
+fake udev, a fake accelerometer and a fake device tree. Device operations are
+recorded by the fake backend of spin instead of carried out, unless --shim is
+given, in which case they go through recording xinput and xrandr scripts as
+well.
+
+Matching command lines against usage messages with subcommands for many
+devices and orientations is timed as well, and so are slow commands for
+different devices, which must run side by side.
+
+The startup of spin.py --nogui is measured separately, in fresh processes,
+from launch until the control socket answers, together with the peak resident
+memory, and so is a one-shot command, passed to the running spin or carried out
+with no spin running, from launch until it exits. The benchmark fails if any of
+them is over budget, or if Qt is loaded.
+
+Usage:
+    benchmark.py [options]
+    benchmark.py -h | --help
+Options:
+    -h, --help          : show this help message
+    --events=<n>        : number of events per scenario [default: 1000]
+    --starts=<n>        : number of times to start spin [default: 10]
+    --records=<n>       : number of records to replay [default: 100000]
+    --startup-budget=<ms>
+                        : maximum median startup time [default: 250]
+    --rss-budget=<MB>   : maximum peak resident memory [default: 30]
+    --command-budget=<ms>
+                        : maximum median time of a one-shot command
+                          [default: 100]
+    --shim              : run the commands through recording xinput and xrandr
+                          scripts
+    --json              : print the results as JSON
+
+"""
+
+
+###############################################################################
+#                                                                             #
+# This file is part of spin, and released under the terms of the GNU General  #
+# Public License version 3 (GPLv3). See spin.py for details.                  #
+#                                                                             #
+###############################################################################
+
+
+import docopt as docoptModule
+from docopt import docopt
+import os
+import sys
+import json
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+import math
+import py_compile
+import spin
+import spincore
+
+#pylint: disable=C0103,C0111
+
+# A ThinkPad Yoga, as seen in /proc/bus/input/devices
+DEVICES = """\
+I: Bus=0003 Vendor=04f3 Product=000a Version=0110
+N: Name="ELAN Touchscreen"
+H: Handlers=mouse1 event9
+B: PROP=2
+B: EV=b
+B: KEY=400 0 0 0 0 0
+B: ABS=3273800000000003
+
+I: Bus=0003 Vendor=056a Product=00ec Version=0100
+N: Name="Wacom ISDv4 EC Pen"
+H: Handlers=mouse2 event10
+B: PROP=2
+B: EV=b
+B: KEY=1c03 0 0 0 0 0
+B: ABS=1000003
+
+I: Bus=0011 Vendor=0002 Product=0007 Version=01b1
+N: Name="SynPS/2 Synaptics TouchPad"
+H: Handlers=mouse0 event5
+B: PROP=5
+B: EV=b
+B: KEY=e520 10000 0 0 0 0
+B: ABS=660800011000003
+
+I: Bus=0011 Vendor=0002 Product=000a Version=0000
+N: Name="TPPS/2 IBM TrackPoint"
+H: Handlers=mouse3 event6
+B: PROP=0
+B: EV=7
+B: KEY=70000 0 0 0 0
+B: REL=3
+"""
+
+ACPI_EVENT = b"ibm/hotkey LEN0068:00 00000080 000060c0\n"
+
+# A touchscreen on a dock, as seen in /proc/bus/input/devices
+DOCK_DEVICE = """\
+I: Bus=0003 Vendor=0eef Product=0001 Version=0100
+N: Name="Dock Touchscreen {a1}"
+S: Sysfs=/devices/pci0000:00/usb3/3-{a1}/input/input{a2}
+H: Handlers=mouse{a2} event{a2}
+B: PROP=2
+B: EV=b
+B: KEY=400 0 0 0 0 0
+B: ABS=3
+"""
+
+# The uevents udev broadcasts as a dock is plugged in; those of the usb and
+# hid subsystems are dropped by the socket filter of spin
+DOCK_UEVENTS = ["usb", "usb", "hid", "input", "input", "usb"]
+
+# An accelerometer with 12-bit samples stored in 16 bits and shifted by 4, and
+# a 64-bit timestamp, which is aligned to 8 bytes: each frame holds x, y and z,
+# 2 bytes of padding and the timestamp
+SCAN_ELEMENTS = [("in_accel_x", "le:s12/16>>4"),
+                 ("in_accel_y", "le:s12/16>>4"),
+                 ("in_accel_z", "le:s12/16>>4"),
+                 ("in_timestamp", "le:s64/64>>0")]
+ACCEL_FRAME = struct.Struct("<HHH2xq")
+GRAVITY = 1000
+
+SHIM = """\
+#!/bin/sh
+echo "$(basename "$0") $*" >> "{a1}"
+"""
+
+clock = spincore.EventLoop.clock
+
+
+class ShimBackend(spincore.FakeBackend):
+    """FakeBackend that also runs each batch as xinput and xrandr commands,
+    and records it once the commands have finished."""
+
+    def __init__(self):
+        spincore.FakeBackend.__init__(self, clock)
+        self.commands = spincore.XCommandBackend()
+
+    def submit(self, operations, callback):
+        if not operations:
+            callback([])
+            return
+        self.commands.submit(
+            operations, lambda results: spincore.FakeBackend.submit(
+                self, operations, lambda _: callback(results)))
+
+
+class FakeUdev(object):
+    """Sends uevents to spin as udev does, in messages with a libudev
+    header."""
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, properties):
+        payload = b"".join("{a1}={a2}".format(a1=key, a2=value).encode() +
+                           b"\0" for key, value in sorted(properties.items()))
+        header = (spincore.UDEV_PREFIX +
+                  struct.pack("!I", spincore.UDEV_MONITOR_MAGIC) +
+                  struct.pack("=III", 40, 40, len(payload)) +
+                  struct.pack("!II", spincore.murmurHash2(
+                      properties["SUBSYSTEM"].encode()), 0) +
+                  struct.pack("=II", 0, 0))
+        self.socket.sendto(header + payload, self.path)
+
+
+class FakeAcpid(object):
+    """acpid socket server sending events to a single client."""
+
+    def __init__(self, path):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.client = None
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept(self):
+        self.client, _ = self.server.accept()
+
+    def send(self, data):
+        self.thread.join()
+        self.client.sendall(data)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def summarize(name, count, latencies, elapsed, batches):
+    operations = [len(batch) for _, batch in batches]
+    return {
+        "scenario": name,
+        "events": count,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "throughput": count / elapsed,
+        "commands": float(sum(operations)) / len(operations),
+    }
+
+
+def measure(backend, inject, count, burst=True):
+    """Inject count events one at a time, then, with burst, count events all
+    at once.
+
+    inject is passed the sequence number of each event, which must lead to
+    one batch of operations. Return the latencies of the single events, the
+    time taken by the burst, or by the single events without it, and the
+    batches.
+    """
+    latencies = []
+    for i in range(count):
+        expected = len(backend.batches) + 1
+        start = clock()
+        inject(i)
+        end, _ = backend.wait(expected)
+        latencies.append(end - start)
+    if not burst:
+        return latencies, sum(latencies), backend.batches[-count:]
+    first = len(backend.batches)
+    start = clock()
+    for i in range(count, 2 * count):
+        inject(i)
+    backend.wait(first + count)
+    elapsed = clock() - start
+    return latencies, elapsed, backend.batches[-2 * count:]
+
+
+def undebounced(interface, function, *args):
+    """Call function with args, with debouncing turned off, as a burst of
+    events would be coalesced into a single transition."""
+    settle, duplicate = interface.modeSwitch.settle, \
+        interface.modeSwitch.duplicate
+    interface.modeSwitch.settle = interface.modeSwitch.duplicate = 0
+    try:
+        return function(*args)
+    finally:
+        interface.modeSwitch.settle = settle
+        interface.modeSwitch.duplicate = duplicate
+
+
+def benchmarkAcpi(interface, backend, acpid, count):
+    """Time the reaction to single ACPI events."""
+    return undebounced(interface, measure, backend,
+                       lambda i: acpid.send(ACPI_EVENT), count, False)
+
+
+def benchmarkSplitAcpi(interface, backend, acpid, count):
+    """Send count ACPI events in two writes each, cut at a different place
+    every time, with a pause in between so that spin reads the pieces apart.
+    Check that each event leads to one transition, once it is complete."""
+    def split():
+        first = len(backend.batches)
+        early = 0
+        for i in range(count):
+            cut = i % (len(ACPI_EVENT) - 1) + 1
+            sent = len(backend.batches)
+            acpid.send(ACPI_EVENT[:cut])
+            time.sleep(0.005)
+            early += len(backend.batches) != sent
+            acpid.send(ACPI_EVENT[cut:])
+            try:
+                backend.wait(sent + 1)
+            except spincore.BackendError:
+                break
+        return len(backend.batches) - first, early
+    transitions, early = undebounced(interface, split)
+    return {
+        "scenario": "acpi-split",
+        "events": count,
+        "transitions": transitions,
+        "early": early,
+        "ok": transitions == count and early == 0,
+    }
+
+
+def benchmarkHinge(interface, backend, acpid, flips):
+    """Wiggle the hinge: send flips pairs of duplicate ACPI events, spaced
+    just beyond the duplicate window, and return the time from the first
+    event until spin has settled, and the number of transitions made."""
+    # Keep the first event from being taken as a duplicate of an earlier one
+    time.sleep(interface.modeSwitch.duplicate * 1.2)
+    first = len(backend.batches)
+    suppressed = interface.modeSwitch.suppressed
+    start = clock()
+    for _ in range(flips):
+        acpid.send(ACPI_EVENT * 2)
+        time.sleep(interface.modeSwitch.duplicate * 1.2)
+    time.sleep(interface.modeSwitch.settle * 2)
+    end, _ = backend.wait(first + 1)
+    transitions = len(backend.batches) - first
+    result = {
+        "scenario": "hinge",
+        "events": 2 * flips,
+        "settled": (end - start) * 1000,
+        "transitions": transitions,
+        "suppressed": interface.modeSwitch.suppressed - suppressed,
+    }
+    result["ok"] = transitions == 1
+    return result
+
+
+def benchmarkSwitch(interface, backend, directory):
+    """Follow a tablet mode switch through a FIFO given as --switch, and play
+    a recorded stream of switch events to it: the switch turned on, with the
+    first event split across two writes; the same state reported again; a
+    wiggle within the settle time; and two changes within one report. Check
+    that these end in the transitions to tablet and back to laptop mode, and
+    no others."""
+    path = os.path.join(directory, "switch")
+    os.mkfifo(path)
+    # Keep the FIFO open for writing, so that spin never sees end of file
+    switch = os.open(path, os.O_RDWR)
+    interface.args["--switch"] = path
+    interface.loop.callSoon(interface.deviceStateMonitoringOff)
+    interface.loop.callSoon(interface.deviceStateMonitoringOn)
+    interface.loop.callSoon(interface.engageModeLaptop)
+    time.sleep(0.1)
+    settle = interface.modeSwitch.settle
+    first = len(backend.batches)
+    modes = []
+
+    def report(*values):
+        """Write an EV_SW event for each value, and a SYN_REPORT."""
+        return b"".join(spincore.INPUT_EVENT.pack(
+            0, 0, spincore.EV_SW, spincore.SW_TABLET_MODE, value)
+            for value in values) + spincore.INPUT_EVENT.pack(
+                0, 0, spincore.EV_SYN, spincore.SYN_REPORT, 0)
+
+    def play(*reports):
+        for data in reports:
+            os.write(switch, data)
+            time.sleep(0.01)
+        time.sleep(settle * 2)
+        modes.append(interface.deviceState)
+    on = report(1)
+    play(on[:5], on[5:])
+    play(report(1))
+    play(report(0), report(1), report(0))
+    play(report(1, 0))
+    os.close(switch)
+    touchpad = "SynPS/2 Synaptics TouchPad"
+    transitions = [
+        "laptop" if ("setEnabled", touchpad, True) in operations else
+        "tablet" if ("setEnabled", touchpad, False) in operations else "other"
+        for _, operations in backend.batches[first:]]
+    result = {
+        "scenario": "switch",
+        "modes": modes,
+        "transitions": transitions,
+    }
+    result["ok"] = (interface.switchFd is not None and
+                    modes == ["tablet", "tablet", "laptop", "laptop"] and
+                    transitions == ["tablet", "laptop"])
+    return result
+
+
+def benchmarkStylus(interface, backend, stylus, count):
+    def inject(i):
+        os.write(stylus, spincore.INPUT_EVENT.pack(
+            0, 0, spincore.EV_KEY, spincore.BTN_TOOL_PEN, 1 - i % 2) +
+            spincore.INPUT_EVENT.pack(
+                0, 0, spincore.EV_SYN, spincore.SYN_REPORT, 0))
+    return measure(backend, inject, count)
+
+
+def benchmarkMode(interface, backend, count):
+    modes = (interface.engageModeTablet, interface.engageModeLaptop)
+    if interface.deviceState == "tablet":
+        modes = modes[::-1]
+    return measure(backend, lambda i: interface.loop.callSoon(modes[i % 2]),
+                   count)
+
+
+def benchmarkRotation(interface, backend, count):
+    rotations = (interface.engageLeft, interface.engageInverted,
+                 interface.engageRight, interface.engageNormal)
+    return measure(backend,
+                   lambda i: interface.loop.callSoon(rotations[i % 4]), count)
+
+
+def benchmarkHotplug(interface, backend, directory, count):
+    """Plug in count docks with a touchscreen, one at a time, and unplug
+    them again; check that each touchscreen, and no other device, is brought
+    to the state of the built-in one, and that nothing is done on removal."""
+    udev = FakeUdev(os.path.join(directory, "uevents.socket"))
+    path = os.path.join(directory, "proc", "bus", "input", "devices")
+    received = interface.metrics.counters.get(
+        ("spin_events_total", (("source", "uevent"),)), 0)
+    latencies, ok = [], True
+    for i in range(count):
+        with open(path, "a") as f:
+            f.write("\n" + DOCK_DEVICE.format(a1=i + 1, a2=100 + i))
+        first = len(backend.batches)
+        for subsystem in DOCK_UEVENTS:
+            udev.send({"ACTION": "add", "SUBSYSTEM": subsystem,
+                       "DEVPATH": "/devices/pci0000:00/usb3/3-{a1}".format(
+                           a1=i + 1)})
+        start = clock()
+        end, operations = backend.wait(first + 1)
+        latencies.append(end - start)
+        ok = ok and len(backend.batches) == first + 1 and set(
+            operation[1] for operation in operations) == set(
+                ["Dock Touchscreen {a1}".format(a1=i + 1)])
+    with open(path, "w") as f:
+        f.write(DEVICES)
+    first = len(backend.batches)
+    udev.send({"ACTION": "remove", "SUBSYSTEM": "input",
+               "DEVPATH": "/devices/pci0000:00/usb3/3-1"})
+    time.sleep(spincore.HOTPLUG_SETTLE * 2)
+    received = interface.metrics.counters.get(
+        ("spin_events_total", (("source", "uevent"),)), 0) - received
+    expected = count * DOCK_UEVENTS.count("input") + 1
+    return {
+        "scenario": "hotplug",
+        "docks": count,
+        "sent": count * len(DOCK_UEVENTS) + 1,
+        "received": received,
+        "p50": percentile(latencies, 50) * 1000,
+        "ok": (ok and len(backend.batches) == first and
+               received == expected),
+    }
+
+
+def fakeAccelerometer(directory):
+    """Create the sysfs directory of an IIO accelerometer with SCAN_ELEMENTS,
+    of which only the timestamp is enabled, and return it."""
+    sysfs = os.path.join(directory, "sys", "bus", "iio", "devices",
+                         "iio:device0")
+    os.makedirs(os.path.join(sysfs, "scan_elements"))
+    os.makedirs(os.path.join(sysfs, "buffer"))
+    files = {"name": "accel_3d", "buffer/length": "0", "buffer/enable": "0"}
+    for index, (name, type_) in enumerate(SCAN_ELEMENTS):
+        files["scan_elements/" + name + "_en"] = str(int(
+            name == "in_timestamp"))
+        files["scan_elements/" + name + "_index"] = str(index)
+        files["scan_elements/" + name + "_type"] = type_
+    for name, value in files.items():
+        with open(os.path.join(sysfs, name), "w") as f:
+            f.write(value + "\n")
+    return sysfs
+
+
+def tilt(orientation, degrees, timestamp):
+    """Return a frame of the device tilted by degrees towards the bottom edge
+    of orientation."""
+    side = int(round(GRAVITY * math.sin(math.radians(degrees))))
+    down = int(round(GRAVITY * math.cos(math.radians(degrees))))
+    x, y = {"normal": (0, -side), "inverted": (0, side), "left": (side, 0),
+            "right": (-side, 0)}[orientation]
+    return ACCEL_FRAME.pack(*[(value & 0xfff) << 4 for value in (x, y, down)] +
+                            [timestamp])
+
+
+def benchmarkAccelerometer(interface, backend, directory):
+    """Turn on auto-rotation in tablet mode with a fake accelerometer, and
+    hold the device in a sequence of ways, writing frames to a FIFO. Tilting it
+    left must rotate the display once the settle time has passed; tilting it
+    towards normal by less than the threshold plus hysteresis must not, nor
+    must jittering between two orientations; tilting it clearly right then
+    must."""
+    sysfs = fakeAccelerometer(directory)
+    path = interface.args["--accelerometer"]
+    os.mkfifo(path)
+    # Keep the FIFO open for writing, so that spin never sees end of file
+    fifo = os.open(path, os.O_RDWR)
+    interface.loop.callSoon(interface.engageModeTablet)
+    interface.loop.callSoon(interface.autoRotationOn)
+    time.sleep(0.1)
+    with open(os.path.join(sysfs, "buffer", "enable")) as f:
+        enabled = f.read().strip() == "1"
+    settle = interface.autoRotationFilter.settle
+    first = len(backend.batches)
+    frames = [0]
+
+    def hold(*orientations):
+        """Hold the device tilted each way in turn, a frame at a time, for
+        twice the settle time."""
+        end = clock() + 2 * settle
+        while clock() < end:
+            orientation, degrees = orientations[frames[0] % len(orientations)]
+            os.write(fifo, tilt(orientation, degrees, frames[0]))
+            frames[0] += 1
+            time.sleep(0.01)
+    start = clock()
+    hold(("left", 60))
+    try:
+        end, _ = backend.wait(first + 1)
+    except spincore.BackendError:
+        end = clock()
+    hold(("normal", 40))
+    hold(("right", 60), ("inverted", 60))
+    hold(("right", 60))
+    time.sleep(settle)
+    interface.loop.callSoon(interface.autoRotationOff)
+    time.sleep(0.1)
+    os.close(fifo)
+    rotations = [operations[0][1] for _, operations in
+                 backend.batches[first:] if operations[0][0] == "rotate"]
+    result = {
+        "scenario": "accelerometer",
+        "frames": frames[0],
+        "settled": (end - start) * 1000,
+        "rotations": rotations,
+    }
+    result["ok"] = (enabled and rotations == ["left", "right"] and
+                    len(backend.batches) == first + 2 and
+                    interface.accelerometer.fd is None)
+    return result
+
+
+def benchmarkReplay(interface, backend, directory, count):
+    """Record count stylus proximity changes to an event log, replay it as
+    fast as possible, and check that each one has been acted upon."""
+    path = os.path.join(directory, "events.log")
+    log = spincore.EventLog(path, clock, limit=float("inf"))
+    for i in range(count):
+        log.write("stylus", spincore.packEvents(
+            [(spincore.EV_KEY, spincore.BTN_TOOL_PEN, 1 - i % 2),
+             (spincore.EV_SYN, spincore.SYN_REPORT, 0)]))
+    log.close()
+    size = os.path.getsize(path)
+    # The first record only changes anything if the stylus is out
+    expected = count - (interface.stylusProximity == "in")
+    first = len(backend.batches)
+    done = threading.Event()
+    replayed = []
+    start = clock()
+    interface.loop.callSoon(interface.replay, path, 0,
+                            lambda n: (replayed.append(n), done.set()))
+    done.wait()
+    elapsed = clock() - start
+    os.unlink(path)
+    try:
+        # With --shim, the commands may still be running
+        backend.wait(first + expected, timeout=10.0 + count * 0.01)
+    except spincore.BackendError:
+        pass
+    result = {
+        "scenario": "replay",
+        "records": replayed[0],
+        "bytes": float(size) / count,
+        "throughput": replayed[0] / elapsed,
+        "transitions": len(backend.batches) - first,
+    }
+    result["ok"] = (replayed[0] == count and
+                    result["transitions"] == expected and
+                    interface.stylusProximity == (
+                        "out" if count % 2 == 0 else "in"))
+    return result
+
+
+def startOnce(directory):
+    """Start spin.py --nogui and return its startup time, peak RSS in MB,
+    whether Qt was loaded and the time taken by a one-shot command passed to
+    it."""
+    control = os.path.join(directory, "startup.socket")
+    script = spin.__file__.replace(".pyc", ".py")
+    with open(os.devnull, "w") as devnull:
+        start = clock()
+        process = subprocess.Popen(
+            [sys.executable, script, "--nogui",
+             "--acpid=" + os.path.join(directory, "none.socket"),
+             "--control=" + control,
+             "--config=" + os.path.join(directory, "spin.conf")],
+            stdout=devnull, stderr=devnull)
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("spin exited during startup")
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    client.connect(control)
+                    client.sendall(b"state\n")
+                    if client.recv(65536):
+                        break
+                except socket.error:
+                    time.sleep(0.001)
+                finally:
+                    client.close()
+            elapsed = clock() - start
+            with open("/proc/{a1}/status".format(a1=process.pid)) as f:
+                rss = [int(line.split()[1]) / 1024.0 for line in f
+                       if line.startswith("VmHWM:")][0]
+            with open("/proc/{a1}/maps".format(a1=process.pid)) as f:
+                qt = "PyQt4" in f.read()
+            start = clock()
+            subprocess.call([sys.executable, script, "monitoring", "on",
+                             "--control=" + control],
+                            stdout=devnull, stderr=devnull)
+            command = clock() - start
+        finally:
+            process.send_signal(signal.SIGINT)
+            process.wait()
+    return elapsed, rss, qt, command
+
+
+def commandOnce(directory):
+    """Carry out a one-shot command with the fake backend and no spin running,
+    and return the time taken from launch to exit and whether Qt was
+    imported."""
+    command = [spin.__file__.replace(".pyc", ".py"), "touchpad", "on",
+               "--backend=fake",
+               "--control=" + os.path.join(directory, "none.socket"),
+               "--config=" + os.path.join(directory, "spin.conf")]
+    with open(os.devnull, "w") as devnull:
+        start = clock()
+        subprocess.call([sys.executable] + command,
+                        stdout=devnull, stderr=devnull)
+        elapsed = clock() - start
+    # With -v, Python lists every module it imports
+    output = subprocess.Popen([sys.executable, "-v"] + command,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT).communicate()[0]
+    return elapsed, b"PyQt4" in output
+
+
+def benchmarkStartup(directory, count, startupBudget, rssBudget,
+                     commandBudget):
+    # As it is once spin has run, even where Python does not write bytecode
+    py_compile.compile(spincore.__file__.replace(".pyc", ".py"))
+    times, peaks, qt, commands, colds = [], [], False, [], []
+    for _ in range(count):
+        elapsed, rss, loaded, command = startOnce(directory)
+        times.append(elapsed)
+        peaks.append(rss)
+        qt = qt or loaded
+        commands.append(command)
+        cold, loaded = commandOnce(directory)
+        colds.append(cold)
+        qt = qt or loaded
+    result = {
+        "scenario": "startup",
+        "starts": count,
+        "p50": percentile(times, 50) * 1000,
+        "max": max(times) * 1000,
+        "rss": max(peaks),
+        "qt": qt,
+        "command": percentile(commands, 50) * 1000,
+        "cold": percentile(colds, 50) * 1000,
+        "startupBudget": startupBudget,
+        "rssBudget": rssBudget,
+        "commandBudget": commandBudget,
+    }
+    result["ok"] = (result["p50"] <= startupBudget and
+                    result["rss"] <= rssBudget and not qt and
+                    result["command"] <= commandBudget and
+                    result["cold"] <= commandBudget)
+    return result
+
+
+def benchmarkUsage(directory, count):
+    """Time parsing spin's usage without a cache, with the parsed usage kept
+    in-process and with it loaded from disk."""
+    argv = ["rotate", "left"]
+    cacheDir = os.path.join(directory, "docopt")
+    times = {"cold": [], "memory": [], "disk": []}
+    for _ in range(count):
+        docoptModule._compiled.clear()
+        start = clock()
+        docopt(spin.__doc__, argv)
+        times["cold"].append(clock() - start)
+        start = clock()
+        docopt(spin.__doc__, argv)
+        times["memory"].append(clock() - start)
+        docoptModule._compiled.clear()
+        docopt(spin.__doc__, argv, cache_dir=cacheDir)
+        docoptModule._compiled.clear()
+        start = clock()
+        docopt(spin.__doc__, argv, cache_dir=cacheDir)
+        times["disk"].append(clock() - start)
+    result = {"scenario": "usage", "runs": count}
+    for name, values in times.items():
+        result[name] = percentile(values, 50) * 1000
+    return result
+
+
+def grammar(devices):
+    """Return a usage message with subcommands per device and orientation."""
+    lines = ["    spin.py {a1} (on | off | toggle) [--force] [options]".format(
+        a1="device{a1}".format(a1=n)) for n in range(devices)]
+    lines += ["    spin.py rotate {a1} {a2} [options]".format(
+        a1="device{a1}".format(a1=n), a2=orientation)
+        for n in range(devices)
+        for orientation in ("normal", "inverted", "left", "right")]
+    options = ["    --option{a1}=<value>  : option {a1}".format(a1=n)
+               for n in range(20)]
+    return ("Usage:\n" + "\n".join(lines) + "\nOptions:\n"
+            "    --force  : force\n" + "\n".join(options) + "\n")
+
+
+def benchmarkGrammar(count):
+    """Time matching command lines against usage messages with many
+    alternatives; the usage is parsed once beforehand."""
+    result = {"scenario": "grammar", "runs": count}
+    for devices in (10, 100):
+        doc = grammar(devices)
+        for name, argv in (
+                ("toggle", ["device{a1}".format(a1=devices - 1), "off",
+                            "--force", "--option3=x"]),
+                ("rotate", ["rotate", "device{a1}".format(a1=devices - 1),
+                            "left", "--option1=y"])):
+            docopt(doc, argv)
+            times = []
+            for _ in range(count):
+                start = clock()
+                docopt(doc, argv)
+                times.append(clock() - start)
+            result["{a1}/{a2}".format(a1=name, a2=devices)] = percentile(
+                times, 50) * 1000
+    return result
+
+
+def benchmarkLanes(lanes=spincore.COMMAND_WORKERS, delay=0.2):
+    """Run a slow job in each of several lanes of an executor that already
+    has an idle worker; they must take about as long as one."""
+    executor = spincore.Executor()
+    done = threading.Semaphore(0)
+
+    def job():
+        time.sleep(delay)
+        done.release()
+    executor.submit("first", done.release)
+    done.acquire()
+    while not executor.idle:
+        time.sleep(0.001)
+    start = clock()
+    for lane in range(lanes):
+        executor.submit(lane, job)
+    for _ in range(lanes):
+        done.acquire()
+    elapsed = clock() - start
+    return {
+        "scenario": "lanes",
+        "lanes": lanes,
+        "delay": delay * 1000,
+        "elapsed": elapsed * 1000,
+        "threads": executor.threads,
+        "ok": elapsed < delay * 1.5,
+    }
+
+
+def run(args):
+    count = int(args["--events"])
+    directory = tempfile.mkdtemp(prefix="spin-benchmark-")
+    try:
+        os.makedirs(os.path.join(directory, "proc", "bus", "input"))
+        os.makedirs(os.path.join(directory, "dev", "input"))
+        with open(os.path.join(directory, "proc", "bus", "input", "devices"),
+                  "w") as f:
+            f.write(DEVICES)
+        if args["--shim"]:
+            log = os.path.join(directory, "commands.log")
+            for command in ("xinput", "xrandr"):
+                path = os.path.join(directory, command)
+                with open(path, "w") as f:
+                    f.write(SHIM.format(a1=log))
+                os.chmod(path, 0o755)
+            os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+        stylusPath = os.path.join(directory, "stylus")
+        os.mkfifo(stylusPath)
+        # Keep the FIFO open for writing, so that spin never sees end of file
+        stylus = os.open(stylusPath, os.O_RDWR)
+        acpid = FakeAcpid(os.path.join(directory, "acpid.socket"))
+        if args["--shim"]:
+            backend = ShimBackend()
+        else:
+            backend = spincore.FakeBackend(clock)
+        interface = spincore.Interface(
+            {"--nogui": True, "--stylus": stylusPath,
+             "--autorotate": False,
+             "--accelerometer": os.path.join(directory, "accelerometer"),
+             "--switch": None,
+             "--uevents": os.path.join(directory, "uevents.socket"),
+             "--backend": "fake",
+             "--config": os.path.join(directory, "spin.conf"),
+             "--record": None, "--replay": None, "--replay-speed": "1",
+             "--acpid": os.path.join(directory, "acpid.socket"),
+             "--control": os.path.join(directory, "spin.socket"),
+             "--metrics": None},
+            backend=backend, devices=spincore.DeviceIndex(directory))
+        interface.loop.start()
+        backend.wait(1)  # the touchscreen is enabled as palm rejection starts
+        results = [
+            summarize("acpi", count,
+                      *benchmarkAcpi(interface, backend, acpid, count)),
+            benchmarkSplitAcpi(interface, backend, acpid, 40),
+            benchmarkHinge(interface, backend, acpid, 11),
+            summarize("stylus", count,
+                      *benchmarkStylus(interface, backend, stylus, count)),
+            summarize("mode", count,
+                      *benchmarkMode(interface, backend, count)),
+            summarize("rotate", count,
+                      *benchmarkRotation(interface, backend, count)),
+        ]
+        results.append(benchmarkHotplug(interface, backend, directory, 5))
+        results.append(benchmarkReplay(interface, backend, directory,
+                                       int(args["--records"])))
+        results.append(benchmarkAccelerometer(interface, backend, directory))
+        results.append(benchmarkSwitch(interface, backend, directory))
+        interface.loop.callSoon(interface.loop.stop)
+        os.close(stylus)
+        results.append(benchmarkUsage(directory, count))
+        results.append(benchmarkGrammar(count))
+        results.append(benchmarkLanes())
+        results.append(benchmarkStartup(
+            directory, int(args["--starts"]),
+            float(args["--startup-budget"]), float(args["--rss-budget"]),
+            float(args["--command-budget"])))
+        if args["--shim"]:
+            with open(log) as f:
+                commands = len(f.readlines())
+            results.append({"scenario": "shim", "commands": commands})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def report(results):
+    print("{a1:10} {a2:>7} {a3:>8} {a4:>8} {a5:>8} {a6:>10} {a7:>9}".format(
+        a1="scenario", a2="events", a3="p50 ms", a4="p95 ms", a5="p99 ms",
+        a6="events/s", a7="commands"))
+    for result in results:
+        if result["scenario"] == "shim":
+            print("{a1} xinput and xrandr commands run".format(
+                a1=result["commands"]))
+            continue
+        if result["scenario"] == "acpi-split":
+            print("acpi-split: {events} events in two pieces, {transitions} "
+                  "transitions, {early} before the event was complete: "
+                  "{a1}".format(a1="ok" if result["ok"] else "FAILED",
+                                **result))
+            continue
+        if result["scenario"] == "hinge":
+            print("hinge: {events} events, {transitions} transition(s) "
+                  "{settled:.0f} ms after the first, {suppressed} "
+                  "suppressed: {a1}".format(
+                      a1="ok" if result["ok"] else "FAILED", **result))
+            continue
+        if result["scenario"] == "hotplug":
+            print("hotplug: {docks} docks, {received} of {sent} uevents "
+                  "received, new devices set {p50:.0f} ms after the last: "
+                  "{a1}".format(a1="ok" if result["ok"] else "FAILED",
+                                **result))
+            continue
+        if result["scenario"] == "switch":
+            print("switch: {a1} transition(s): {a2}".format(
+                a1=" then ".join(result["transitions"]) or "no",
+                a2="ok" if result["ok"] else "FAILED"))
+            continue
+        if result["scenario"] == "accelerometer":
+            print("accelerometer: {frames} frames, rotated {a1} {settled:.0f} "
+                  "ms after the first tilt: {a2}".format(
+                      a1=" then ".join(result["rotations"]) or "never",
+                      a2="ok" if result["ok"] else "FAILED", **result))
+            continue
+        if result["scenario"] == "replay":
+            print("replay: {records} records of {bytes:.0f} bytes, "
+                  "{throughput:.0f} records/s, {transitions} transitions: "
+                  "{a1}".format(a1="ok" if result["ok"] else "FAILED",
+                                **result))
+            continue
+        if result["scenario"] == "usage":
+            print("usage: {cold:.3f} ms parsed, {memory:.3f} ms kept "
+                  "in-process, {disk:.3f} ms loaded from disk".format(
+                      **result))
+            continue
+        if result["scenario"] == "grammar":
+            print("grammar: " + ", ".join(
+                "{a1} {a2:.3f} ms".format(a1=key, a2=result[key])
+                for key in sorted(result) if "/" in key))
+            continue
+        if result["scenario"] == "lanes":
+            print("lanes: {lanes} jobs of {delay:.0f} ms in different lanes "
+                  "took {elapsed:.0f} ms on {threads} threads: {a1}".format(
+                      a1="ok" if result["ok"] else "FAILED", **result))
+            continue
+        if result["scenario"] == "startup":
+            print("startup: {p50:.1f} ms median, {max:.1f} ms max "
+                  "(budget {startupBudget:g} ms), {rss:.1f} MB peak RSS "
+                  "(budget {rssBudget:g} MB), Qt {a1}, {command:.1f} ms "
+                  "median command, {cold:.1f} ms without spin running "
+                  "(budget {commandBudget:g} ms): {a2}".format(
+                      a1="loaded" if result["qt"] else "not loaded",
+                      a2="ok" if result["ok"] else "OVER BUDGET", **result))
+            continue
+        print("{scenario:10} {events:7d} {p50:8.3f} {p95:8.3f} {p99:8.3f} "
+              "{throughput:10.0f} {commands:9.2f}".format(**result))
+
+
+def main(args):
+    spincore.LOGGER.setLevel(logging.WARNING)
+    results = run(args)
+    if args["--json"]:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        report(results)
+    if not all(result.get("ok", True) for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -8,6 +8,7 @@
 version: 2014-01-03T0001
 """
 import sys
+import os
 import re
 
 
@@ -41,6 +42,7 @@ class Pattern(object):
     def fix(self):
         self.fix_identities()
         self.fix_repeating_arguments()
+        self.fix_either_commands()
         return self
 
     def fix_identities(self, uniq=None):
@@ -69,6 +71,39 @@ class Pattern(object):
                     e.value = 0
         return self
 
+    def fix_either_commands(self):
+        """Index the alternatives of each Either by their leading commands."""
+        for child in getattr(self, 'children', []):
+            child.fix_either_commands()
+        if type(self) is Either:
+            self.commands = {}
+            for n, child in enumerate(self.children):
+                names = leading_commands(child)
+                self.commands.setdefault(names[0] if names else None,
+                                         []).append((n, names))
+
+
+def leading_commands(pattern):
+    """Return the names of the commands `pattern` must match first.
+
+    They end at the first command that counts its occurrences, as
+    matching it changes what was collected even if `pattern` then fails.
+
+    """
+    if type(pattern) is Command:
+        return (pattern.name,)
+    names = ()
+    if type(pattern) is Required:
+        for child in pattern.children:
+            if type(child) is not Command:
+                if not names:
+                    names = leading_commands(child)
+                break
+            names += (child.name,)
+            if type(child.value) is int:
+                break
+    return names
+
 
 def transform(pattern):
     """Expand pattern into an (almost) equivalent one, but with single Either.
@@ -116,18 +151,17 @@ class LeafPattern(Pattern):
         if match is None:
             return False, left, collected
         left_ = left[:pos] + left[pos + 1:]
-        same_name = [a for a in collected if a.name == self.name]
         if type(self.value) in (int, list):
             if type(self.value) is int:
                 increment = 1
             else:
                 increment = ([match.value] if type(match.value) is str
                              else match.value)
-            if not same_name:
-                match.value = increment
-                return True, left_, collected + [match]
-            same_name[0].value += increment
-            return True, left_, collected
+            for same_name in collected:
+                if same_name.name == self.name:
+                    same_name.value += increment
+                    return True, left_, collected
+            match.value = increment
         return True, left_, collected + [match]
 
 
@@ -258,7 +292,8 @@ class OneOrMore(BranchPattern):
             # could it be that something didn't match but changed l or c?
             matched, l, c = self.children[0].match(l, c)
             times += 1 if matched else 0
-            if l_ == l:
+            # matching only removes from l, so equal lengths mean equal lists
+            if l_ is not None and len(l_) == len(l):
                 break
             l_ = l
         if times >= 1:
@@ -271,7 +306,7 @@ class Either(BranchPattern):
     def match(self, left, collected=None):
         collected = [] if collected is None else collected
         outcomes = []
-        for pattern in self.children:
+        for pattern in self.candidates(left):
             matched, _, _ = outcome = pattern.match(left, collected)
             if matched:
                 outcomes.append(outcome)
@@ -279,6 +314,25 @@ class Either(BranchPattern):
             return min(outcomes, key=lambda outcome: len(outcome[1]))
         return False, left, collected
 
+    def candidates(self, left):
+        """Return the alternatives that may match `left`, in order.
+
+        An alternative that starts with commands can only match if the
+        first arguments left are those commands, so with `commands` set by
+        fix(), the others are skipped without trying them.
+
+        """
+        commands = getattr(self, 'commands', None)
+        if commands is None:
+            return self.children
+        arguments = tuple(a.value for a in left if type(a) is Argument)
+        indices = [n for n, _ in commands.get(None, [])]
+        if arguments and arguments[0] in commands:
+            indices = sorted(indices + [
+                n for n, names in commands[arguments[0]]
+                if arguments[:len(names)] == names])
+        return [self.children[n] for n in indices]
+
 
 class Tokens(list):
 
@@ -488,7 +542,114 @@ class Dict(dict):
         return '{%s}' % ',\n '.join('%r: %r' % i for i in sorted(self.items()))
 
 
-def docopt(doc, argv=None, help=True, version=None, options_first=False):
+def parse_doc(doc):
+    """Parse `doc` into its usage section, options and fixed pattern."""
+    usage_sections = parse_section('usage:', doc)
+    if len(usage_sections) == 0:
+        raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
+    if len(usage_sections) > 1:
+        raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
+    usage = usage_sections[0]
+    options = parse_defaults(doc)
+    pattern = parse_pattern(formal_usage(usage), options)
+    # [default] syntax for argument is disabled
+    #for a in pattern.flat(Argument):
+    #    same_name = [d for d in arguments if d.name == a.name]
+    #    if same_name:
+    #        a.value = same_name[0].value
+    pattern_options = set(pattern.flat(Option))
+    for options_shortcut in pattern.flat(OptionsShortcut):
+        doc_options = parse_defaults(doc)
+        options_shortcut.children = list(set(doc_options) - pattern_options)
+        #if any_options:
+        #    options_shortcut.children += [Option(o.short, o.long, o.argcount)
+        #                    for o in argv if type(o) is Option]
+    pattern.fix()
+    # one leaf per name: the last one, whose value Dict would keep
+    leaves = dict((leaf.name, leaf) for leaf in pattern.flat())
+    return usage, options, pattern, list(leaves.values())
+
+
+_compiled = {}
+
+
+def compile_doc(doc, cache_dir=None):
+    """Return `parse_doc(doc)`, memoized in-process and, if `cache_dir` is
+    given, stored there for later processes.
+
+    Matching never modifies the compiled pattern, so it can be shared by
+    every call with the same doc.
+
+    """
+    key = (__version__, doc)
+    if key not in _compiled:
+        compiled = path = None
+        if cache_dir is not None:
+            path = cache_path(doc, cache_dir)
+            if path is not None:
+                compiled = load_compiled(path)
+        if compiled is None:
+            compiled = parse_doc(doc)
+            if path is not None:
+                store_compiled(path, compiled)
+        _compiled[key] = compiled
+    return _compiled[key]
+
+
+def cache_path(doc, cache_dir):
+    import hashlib
+    data = doc if isinstance(doc, bytes) else doc.encode('utf-8')
+    # the patterns pickled change with this file, not only with its version;
+    # without the source (installed as .pyc only, or zipped), do not cache
+    try:
+        source = os.stat(__file__.replace('.pyc', '.py'))
+    except OSError:
+        return None
+    key = hashlib.sha1(('%s %d %d %d\n' % (
+        __version__, sys.version_info[0], source.st_size,
+        source.st_mtime)).encode('ascii') + data).hexdigest()
+    # named after the program too, so that storing it can drop the stale ones
+    usage = parse_section('usage:', doc)
+    program = usage[0].partition(':')[2].split()[:1] if usage else []
+    program = re.sub(r'[^\w.]', '_', program[0]) if program else 'usage'
+    return os.path.join(cache_dir, 'docopt-%s-py%d-%s.pickle' % (
+        program, sys.version_info[0], key))
+
+
+def load_compiled(path):
+    import pickle
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:  # missing, stale or corrupt: parse again
+        return None
+
+
+def store_compiled(path, compiled):
+    import pickle
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.%d' % os.getpid(), 'wb') as f:
+            pickle.dump(compiled, f, 2)
+        os.rename(path + '.%d' % os.getpid(), path)
+    except (IOError, OSError):
+        return
+    # keep one file per program: those of its earlier usages, docopt versions
+    # and edits of this file are never loaded again
+    directory, name = os.path.split(path)
+    prefix = name.rsplit('-', 1)[0] + '-'
+    try:
+        for other in os.listdir(directory):
+            if (other.startswith(prefix) and other.endswith('.pickle') and
+                    other != name):
+                os.remove(os.path.join(directory, other))
+    except OSError:  # such as removed by another process meanwhile
+        pass
+
+
+def docopt(doc, argv=None, help=True, version=None, options_first=False,
+           cache_dir=None):
     """Parse `argv` based on command-line interface described in `doc`.
 
     `docopt` creates your command-line interface based on its
@@ -512,6 +673,9 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
     options_first : bool (default: False)
         Set to True to require options precede positional arguments,
         i.e. to forbid options and positional arguments intermix.
+    cache_dir : str, optional
+        Directory to keep the parsed `doc` in, so that later runs
+        skip parsing it. It is always kept in-process.
 
     Returns
     -------
@@ -553,30 +717,13 @@ def docopt(doc, argv=None, help=True, version=None, options_first=False):
     """
     argv = sys.argv[1:] if argv is None else argv
 
-    usage_sections = parse_section('usage:', doc)
-    if len(usage_sections) == 0:
-        raise DocoptLanguageError('"usage:" (case-insensitive) not found.')
-    if len(usage_sections) > 1:
-        raise DocoptLanguageError('More than one "usage:" (case-insensitive).')
-    DocoptExit.usage = usage_sections[0]
-
-    options = parse_defaults(doc)
-    pattern = parse_pattern(formal_usage(DocoptExit.usage), options)
-    # [default] syntax for argument is disabled
-    #for a in pattern.flat(Argument):
-    #    same_name = [d for d in arguments if d.name == a.name]
-    #    if same_name:
-    #        a.value = same_name[0].value
+    usage, options, pattern, leaves = compile_doc(doc, cache_dir)
+    DocoptExit.usage = usage
     argv = parse_argv(Tokens(argv), list(options), options_first)
-    pattern_options = set(pattern.flat(Option))
-    for options_shortcut in pattern.flat(OptionsShortcut):
-        doc_options = parse_defaults(doc)
-        options_shortcut.children = list(set(doc_options) - pattern_options)
-        #if any_options:
-        #    options_shortcut.children += [Option(o.short, o.long, o.argcount)
-        #                    for o in argv if type(o) is Option]
     extras(help, version, argv, doc)
-    matched, left, collected = pattern.fix().match(argv)
+    matched, left, collected = pattern.match(argv)
     if matched and left == []:  # better error message if left?
-        return Dict((a.name, a.value) for a in (pattern.flat() + collected))
-    raise DocoptExit()
\ No newline at end of file
+        # copy list defaults, which are shared by every call with this doc
+        return Dict((a.name, list(a.value) if type(a.value) is list
+                     else a.value) for a in (leaves + collected))
+    raise DocoptExit()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+"""Generate a command line parser from the usage message of a script.
+
+The usage message, the docstring of the script, is parsed once with docopt and
+compiled into a module that parses command lines exactly like docopt, without
+needing docopt: the pattern is turned into straight-line matching code. spin.py
+uses spin_usage.py in place of docopt while it is up to date.
+
+With --check, the generated parser is compared with docopt on command lines
+made up from the usage message, and parsergen.py exits with an error if they
+ever disagree.
+
+Usage:
+    parsergen.py <script> [options]
+    parsergen.py -h | --help
+Options:
+    -h, --help          : show this help message
+    --output=<module>   : file to write the parser to (default: <script> with
+                          _usage.py in place of .py)
+    --check             : compare the parser with docopt
+    --cases=<n>         : number of command lines to compare [default: 2000]
+    --seed=<n>          : seed of the command lines to compare [default: 0]
+
+"""
+
+
+###############################################################################
+#                                                                             #
+# This file is part of spin, and released under the terms of the GNU General  #
+# Public License version 3 (GPLv3). See spin.py for details.                  #
+#                                                                             #
+###############################################################################
+
+
+import ast
+import os
+import sys
+import random
+from docopt import docopt
+import docopt as docoptModule
+from docopt import (Required, Optional, OneOrMore, Either, Option, Argument,
+                    Command)
+
+#pylint: disable=C0103,C0111
+
+# Parsing of argv is the same for every usage message; it follows docopt's
+# parse_argv, with options as (short, long, argcount) and the parsed command
+# line as [kind, name, value] lists.
+RUNTIME = r'''
+
+class UsageExit(SystemExit):
+    """Exit in case the command line does not match the usage message."""
+
+    def __init__(self, message=''):
+        SystemExit.__init__(self, (message + '\n' + USAGE).strip())
+
+
+def parse_long(tokens, options):
+    long, eq, value = tokens.pop(0).partition('=')
+    value = None if eq == value == '' else value
+    similar = [o for o in options if o[1] == long]
+    if similar == []:
+        similar = [o for o in options if o[1] and o[1].startswith(long)]
+    if len(similar) > 1:
+        raise UsageExit('%s is not a unique prefix: %s?' %
+                        (long, ', '.join(o[1] for o in similar)))
+    elif len(similar) < 1:
+        argcount = 1 if eq == '=' else 0
+        options.append((None, long, argcount))
+        return [['option', long, value if argcount else True]]
+    short, long, argcount = similar[0]
+    if argcount == 0:
+        if value is not None:
+            raise UsageExit('%s must not have an argument' % long)
+    elif value is None:
+        if tokens == [] or tokens[0] == '--':
+            raise UsageExit('%s requires argument' % long)
+        value = tokens.pop(0)
+    return [['option', long, value if value is not None else True]]
+
+
+def parse_shorts(tokens, options):
+    left = tokens.pop(0).lstrip('-')
+    parsed = []
+    while left != '':
+        short, left = '-' + left[0], left[1:]
+        similar = [o for o in options if o[0] == short]
+        if len(similar) > 1:
+            raise UsageExit('%s is specified ambiguously %d times' %
+                            (short, len(similar)))
+        elif len(similar) < 1:
+            options.append((short, None, 0))
+            parsed.append(['option', short, True])
+            continue
+        value = None
+        if similar[0][2] != 0:
+            if left == '':
+                if tokens == [] or tokens[0] == '--':
+                    raise UsageExit('%s requires argument' % short)
+                value = tokens.pop(0)
+            else:
+                value = left
+                left = ''
+        parsed.append(['option', similar[0][1] or short,
+                       value if value is not None else True])
+    return parsed
+
+
+def parse_argv(tokens, options, options_first):
+    parsed = []
+    while tokens:
+        if tokens[0] == '--':
+            return parsed + [['argument', None, v] for v in tokens]
+        elif tokens[0].startswith('--'):
+            parsed += parse_long(tokens, options)
+        elif tokens[0].startswith('-') and tokens[0] != '-':
+            parsed += parse_shorts(tokens, options)
+        elif options_first:
+            return parsed + [['argument', None, v] for v in tokens]
+        else:
+            parsed.append(['argument', None, tokens.pop(0)])
+    return parsed
+
+
+def first_argument(left):
+    for n, item in enumerate(left):
+        if item[0] == 'argument':
+            return n
+    return None
+
+
+def parse(argv=None, help=True, version=None, options_first=False):
+    """Parse argv, sys.argv[1:] by default, like docopt(DOC, argv)."""
+    argv = sys.argv[1:] if argv is None else argv
+    parsed = parse_argv(list(argv), list(OPTIONS), options_first)
+    if help and any(item[1] in ('-h', '--help') and item[2]
+                    for item in parsed):
+        print(DOC.strip('\n'))
+        sys.exit()
+    if version and any(item[1] == '--version' and item[2]
+                       for item in parsed):
+        print(version)
+        sys.exit()
+    matched, left, collected = match_0(parsed, [])
+    if matched and left == []:
+        arguments = defaults()
+        for item in collected:
+            arguments[item[1]] = (list(item[2]) if type(item[2]) is list
+                                  else item[2])
+        return arguments
+    raise UsageExit()
+'''
+
+
+class Generator(object):
+    """Generates one matching function per node of a fixed docopt pattern.
+
+    Nodes shared between alternatives, as docopt makes equal leaves, get a
+    single function.
+    """
+
+    def __init__(self, pattern):
+        self.numbers = {}
+        self.functions = []
+        self.tables = []
+        self.function(pattern)
+
+    def function(self, node):
+        """Return the name of the function matching node, generating it."""
+        if id(node) not in self.numbers:
+            number = len(self.numbers)
+            self.numbers[id(node)] = number
+            name = "match_{a1}".format(a1=number)
+            # Reserve the place, so that the root comes first
+            self.functions.append(None)
+            index = len(self.functions) - 1
+            if isinstance(node, Either):
+                body = self.either(node, number)
+            elif isinstance(node, OneOrMore):
+                body = self.oneOrMore(node)
+            elif isinstance(node, Optional):
+                body = self.optional(node)
+            elif isinstance(node, Required):
+                body = self.required(node)
+            else:
+                body = self.leaf(node)
+            self.functions[index] = (
+                "def {a1}(left, collected):\n"
+                "    # {a2}\n".format(a1=name, a2=describe(node)) +
+                "".join("    " + line + "\n" for line in body))
+        return "match_{a1}".format(a1=self.numbers[id(node)])
+
+    def required(self, node):
+        lines = ["l, c = left, collected"]
+        for child in node.children:
+            lines += [
+                "matched, l, c = {a1}(l, c)".format(a1=self.function(child)),
+                "if not matched:",
+                "    return False, left, collected",
+            ]
+        return lines + ["return True, l, c"]
+
+    def optional(self, node):
+        lines = []
+        for child in node.children:
+            lines.append("matched, left, collected = {a1}(left, collected)"
+                         .format(a1=self.function(child)))
+        return lines + ["return True, left, collected"]
+
+    def oneOrMore(self, node):
+        return [
+            "l, c, l_ = left, collected, None",
+            "matched = True",
+            "times = 0",
+            "while matched:",
+            "    matched, l, c = {a1}(l, c)".format(
+                a1=self.function(node.children[0])),
+            "    times += 1 if matched else 0",
+            "    if l_ is not None and len(l_) == len(l):",
+            "        break",
+            "    l_ = l",
+            "if times >= 1:",
+            "    return True, l, c",
+            "return False, left, collected",
+        ]
+
+    def either(self, node, number):
+        """Try the alternatives that may match, as Either.candidates does,
+        and keep the outcome that leaves the fewest arguments."""
+        always = []
+        groups = {}
+        for n, names in sorted(item for items in node.commands.values()
+                               for item in items):
+            entry = (n, names, self.function(node.children[n]))
+            if names:
+                groups.setdefault(names[0], []).append(entry)
+            else:
+                always.append(entry)
+        lines = []
+        if groups:
+            table = "COMMANDS_{a1}".format(a1=number)
+            self.tables.append("{a1} = {{\n{a2}}}\n".format(
+                a1=table, a2="".join(
+                    "    {a1!r}: [{a2}],\n".format(a1=first, a2=", ".join(
+                        "({a1}, {a2!r}, {a3})".format(a1=n, a2=names, a3=f)
+                        for n, names, f in entries))
+                    for first, entries in sorted(groups.items()))))
+            lines += [
+                "arguments = tuple(item[2] for item in left",
+                "                  if item[0] == 'argument')",
+                "candidates = [{a1}]".format(a1=", ".join(
+                    "({a1}, {a2})".format(a1=n, a2=f)
+                    for n, _, f in always)),
+                "if arguments and arguments[0] in {a1}:".format(a1=table),
+                "    candidates = sorted(candidates + [",
+                "        (n, f) for n, names, f in {a1}[arguments[0]]".format(
+                    a1=table),
+                "        if arguments[:len(names)] == names])",
+                "outcomes = []",
+                "for _, f in candidates:",
+                "    outcome = f(left, collected)",
+                "    if outcome[0]:",
+                "        outcomes.append(outcome)",
+            ]
+        else:
+            lines.append("outcomes = []")
+            for _, _, f in always:
+                lines += ["outcome = {a1}(left, collected)".format(a1=f),
+                          "if outcome[0]:",
+                          "    outcomes.append(outcome)"]
+        return lines + [
+            "if outcomes:",
+            "    return min(outcomes, key=lambda outcome: len(outcome[1]))",
+            "return False, left, collected",
+        ]
+
+    def leaf(self, node):
+        if type(node) is Command:
+            lines = [
+                "pos = first_argument(left)",
+                "if pos is None or left[pos][2] != {a1!r}:".format(
+                    a1=node.name),
+                "    return False, left, collected",
+                "match = ['command', {a1!r}, True]".format(a1=node.name),
+            ]
+        elif type(node) is Argument:
+            lines = [
+                "pos = first_argument(left)",
+                "if pos is None:",
+                "    return False, left, collected",
+                "match = ['argument', {a1!r}, left[pos][2]]".format(
+                    a1=node.name),
+            ]
+        elif type(node) is Option:
+            lines = [
+                "for pos, match in enumerate(left):",
+                "    if match[1] == {a1!r}:".format(a1=node.name),
+                "        break",
+                "else:",
+                "    return False, left, collected",
+            ]
+        else:
+            raise ValueError("cannot generate {a1!r}".format(a1=node))
+        lines.append("left_ = left[:pos] + left[pos + 1:]")
+        if type(node.value) in (int, list):
+            if type(node.value) is int:
+                lines.append("increment = 1")
+            else:
+                lines.append("increment = ([match[2]] if type(match[2]) is "
+                             "str else match[2])")
+            lines += [
+                "for same_name in collected:",
+                "    if same_name[1] == {a1!r}:".format(a1=node.name),
+                "        same_name[2] += increment",
+                "        return True, left_, collected",
+                "match[2] = increment",
+            ]
+        return lines + ["return True, left_, collected + [match]"]
+
+
+def describe(node):
+    text = repr(node)
+    return text if len(text) <= 70 else text[:67] + "..."
+
+
+def generate(script, doc):
+    """Return the source of a parser module for the usage message doc."""
+    usage, options, pattern, leaves = docoptModule.parse_doc(doc)
+    generator = Generator(pattern)
+    defaults = "{{\n{a1}    }}".format(a1="".join(
+        "        {a1!r}: {a2!r},\n".format(a1=leaf.name, a2=leaf.value)
+        for leaf in sorted(leaves, key=lambda leaf: leaf.name)))
+    return "".join([
+        '"""Command line parser for {a1}, generated by parsergen.py.\n\n'
+        'Do not edit; run parsergen.py {a1} again when its usage message '
+        'changes.\n"""\n\n'.format(a1=os.path.basename(script)),
+        "import sys\n\n\n",
+        "DOC = {a1!r}\n\n".format(a1=doc),
+        "USAGE = {a1!r}\n\n".format(a1=usage),
+        "OPTIONS = [\n{a1}]\n".format(a1="".join(
+            "    ({a1!r}, {a2!r}, {a3!r}),\n".format(
+                a1=option.short, a2=option.long, a3=option.argcount)
+            for option in options)),
+        RUNTIME,
+        "\n\ndef defaults():\n    return {a1}\n".format(a1=defaults),
+        "".join("\n\n" + function for function in generator.functions),
+        "".join("\n\n" + table for table in generator.tables),
+    ])
+
+
+def commandLines(doc, count, seed):
+    """Make up command lines from the words of the usage message and the
+    alternatives of its pattern, valid or not."""
+    rng = random.Random(seed)
+    _, options, pattern, _ = docoptModule.parse_doc(doc)
+    words = ["--", "-", "x", "-h", "--help", "--bogus", "-Z", "--b"]
+    for leaf in pattern.flat():
+        if type(leaf) is Command:
+            words.append(leaf.name)
+        elif type(leaf) is Argument:
+            words += ["value", "other"]
+    for option in options:
+        if option.long:
+            words += [option.long, option.long[:4],
+                      option.long + "=value" if option.argcount else
+                      option.long + "=x"]
+        if option.short:
+            words += [option.short, option.short + "value"]
+    alternatives = [list(alternative(child)) for child in pattern.children]
+    lines = [[]]
+    while len(lines) < count:
+        if rng.random() < 0.6:
+            line = list(rng.choice(rng.choice(alternatives)))
+            for _ in range(rng.randint(0, 2)):
+                if line and rng.random() < 0.5:
+                    line.pop(rng.randrange(len(line)))
+                else:
+                    line.insert(rng.randint(0, len(line)), rng.choice(words))
+        else:
+            line = [rng.choice(words) for _ in range(rng.randint(1, 5))]
+        lines.append(line)
+    return lines
+
+
+def alternative(node):
+    """Yield example command lines for each alternative of node."""
+    if isinstance(node, Either):
+        for child in node.children:
+            for line in alternative(child):
+                yield line
+    elif isinstance(node, Optional):
+        yield []
+        for line in alternative(Required(*node.children)):
+            yield line
+    elif isinstance(node, OneOrMore):
+        for line in alternative(node.children[0]):
+            yield line
+            yield line + line
+    elif isinstance(node, Required):
+        lines = [[]]
+        for child in node.children:
+            lines = [line + more for line in lines[:8]
+                     for more in list(alternative(child))[:8]]
+        for line in lines:
+            yield line
+    elif type(node) is Command:
+        yield [node.name]
+    elif type(node) is Argument:
+        yield ["value"]
+    elif node.argcount:
+        yield [node.long + "=value" if node.long else node.short + "value"]
+    else:
+        yield [node.long or node.short]
+
+
+def outcome(parse, argv):
+    """Return what parse does with argv: its result or exit, and output."""
+    output = []
+
+    class Capture(object):
+        def write(self, text):
+            output.append(text)
+
+    stdout, sys.stdout = sys.stdout, Capture()
+    try:
+        result = ("arguments", dict(parse(argv)))
+    except SystemExit as e:
+        result = ("exit", e.code)
+    finally:
+        sys.stdout = stdout
+    return result, "".join(output)
+
+
+def check(doc, module, count, seed):
+    """Compare the parser in module with docopt; return the differences."""
+    namespace = {}
+    exec(compile(module, "<generated>", "exec"), namespace)
+    differences = []
+    for argv in commandLines(doc, count, seed):
+        expected = outcome(lambda argv: docopt(doc, argv), argv)
+        actual = outcome(namespace["parse"], argv)
+        if actual != expected:
+            differences.append((argv, expected, actual))
+    return differences
+
+
+def main(args):
+    script = args["<script>"]
+    with open(script) as f:
+        doc = ast.get_docstring(ast.parse(f.read()), clean=False)
+    if doc is None:
+        sys.exit("{a1} has no usage message".format(a1=script))
+    module = generate(script, doc)
+    output = args["--output"] or script[:-len(".py")] + "_usage.py"
+    with open(output + ".tmp", "w") as f:
+        f.write(module)
+    os.rename(output + ".tmp", output)
+    print("wrote {a1}".format(a1=output))
+    if args["--check"]:
+        count = int(args["--cases"])
+        differences = check(doc, module, count, int(args["--seed"]))
+        for argv, expected, actual in differences[:10]:
+            print("{a1}: docopt {a2!r}, parser {a3!r}".format(
+                a1=" ".join(argv) or "(no arguments)", a2=expected,
+                a3=actual))
+        print("{a1} of {a2} command lines differ".format(
+            a1=len(differences), a2=count))
+        if differences:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,3290 @@
+#!/usr/bin/env python
+
+"""The implementation of spin, run by spin.py.
+
+spin.py only holds the usage message and hands the command line over to main,
+so that Python keeps this module compiled and a command does not compile all
+of spin every time it is run.
+
+"""
+
+
+###############################################################################
+#                                                                             #
+# This file is part of spin, and released under the terms of the GNU General  #
+# Public License version 3 (GPLv3). See spin.py for details.                  #
+#                                                                             #
+###############################################################################
+
+
+import os
+import sys
+import errno
+import select
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+import fcntl
+import fnmatch
+import heapq
+import itertools
+import json
+import bisect
+import glob
+import math
+import mmap
+import re
+from collections import deque, namedtuple
+import logging
+
+# Disable selected pylint error messages
+#C0103: Invalid %s name "%s"
+#C0111: Missing %s docstring
+#R0904: Too many public methods (%s/%s)
+#R0915: Too many statements (%s/%s)
+#pylint: disable=C0103,C0111,R0904,R0915
+
+# Enable logging
+LOGGER = logging.getLogger("spin")
+logging.basicConfig()
+LOGGER.level = logging.INFO
+
+# Linux input event interface, see <linux/input.h>
+# struct input_event {struct timeval time; __u16 type; __u16 code; __s32 value}
+INPUT_EVENT = struct.Struct('llHHi')
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+EV_ABS = 0x03
+EV_SW = 0x05
+SYN_REPORT = 0
+REL_X = 0x00
+ABS_X = 0x00
+BTN_LEFT = 0x110
+BTN_TOOL_PEN = 0x140
+BTN_TOOL_RUBBER = 0x141
+BTN_TOOL_FINGER = 0x145
+BTN_TOUCH = 0x14a
+KEY_MAX = 0x2ff
+SW_TABLET_MODE = 0x01
+SW_MAX = 0x10
+INPUT_PROP_POINTER = 0x00
+INPUT_PROP_DIRECT = 0x01
+INPUT_PROP_POINTING_STICK = 0x05
+BUS_I8042 = 0x11
+VENDOR_PSMOUSE = 0x0002
+PRODUCT_TRACKPOINT = 0x000a
+VENDOR_WACOM = 0x056a
+LONG_BITS = struct.calcsize('l') * 8
+
+# acpid events that signal a change between the laptop and tablet states,
+# matched field by field: device class, bus id, event type and event code
+ACPI_TRIGGERS = ["ibm/hotkey * 00000080 000060c0"]
+
+# Event log records: a header of monotonic time, source and payload length,
+# followed by the payload, which is the data read from acpid or the input
+# events read from an evdev node, packed as LOG_EVENT
+LOG_MAGIC = b"spinlog1"
+LOG_RECORD = struct.Struct('<dBH')
+LOG_EVENT = struct.Struct('<HHi')
+LOG_SOURCES = ("acpi", "stylus", "switch")
+LOG_LIMIT = 8 * 1024 * 1024
+
+# Inotify events, see <sys/inotify.h>
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[]}
+INOTIFY_EVENT = struct.Struct('iIII')
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+
+# udev messages on the uevent netlink socket, see libudev's udev-monitor.c:
+# "libudev\0", a magic number, the header size, the offset and length of the
+# properties, and the hashes of the subsystem and device type, followed by the
+# properties; the magic number and hashes are in network byte order
+NETLINK_KOBJECT_UEVENT = 15
+UDEV_MONITOR_GROUP = 2
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+UDEV_PREFIX = b"libudev\0"
+UDEV_MAGIC_OFFSET = 8
+UDEV_PROPERTIES = struct.Struct('=II')
+UDEV_PROPERTIES_OFFSET = 16
+UDEV_SUBSYSTEM_OFFSET = 24
+UEVENT_BUFFER = 8192
+
+# Classic BPF socket filters, see <linux/filter.h>
+# struct sock_filter {uint16_t code; uint8_t jt, jf; uint32_t k}
+SO_ATTACH_FILTER = 26
+SOCK_FILTER = struct.Struct('HBBI')
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+
+# Subsystems whose uevents make spin look for input devices again, and the
+# time to wait for the burst of uevents from a dock to end
+HOTPLUG_SUBSYSTEMS = ("input", "drm")
+HOTPLUG_SETTLE = 0.5
+
+# Time between queries of the stylus proximity through xinput, for palm
+# rejection without access to the evdev node of the stylus
+PROXIMITY_POLL_INTERVAL = 0.2
+
+# Input device roles
+TOUCHSCREEN = "touchscreen"
+TOUCHPAD = "touchpad"
+NIPPLE = "nipple"
+STYLUS = "stylus"
+ERASER = "eraser"
+TABLET_SWITCH = "tablet-switch"
+
+# Absolute pointer devices, whose coordinates have to follow the display
+# orientation; not every device has a pen
+PENS = (STYLUS, ERASER)
+POINTERS = (TOUCHSCREEN,) + PENS
+
+# Devices that are enabled or disabled with the mode
+SWITCHABLE = (TOUCHSCREEN, TOUCHPAD, NIPPLE)
+DISABLED = {"laptop": (), "tablet": (TOUCHPAD, NIPPLE)}
+
+# The Wacom X driver splits each kernel device into one X device per tool,
+# named after the kernel device and the tool
+WACOM_TOOLS = {TOUCHSCREEN: "touch", TOUCHPAD: "touch", STYLUS: "stylus",
+               ERASER: "eraser"}
+
+# Coordinate Transformation Matrix for each display orientation
+MATRICES = {
+    "normal": (1, 0, 0, 0, 1, 0, 0, 0, 1),
+    "inverted": (-1, 0, 1, 0, -1, 1, 0, 0, 1),
+    "left": (0, -1, 1, 1, 0, 0, 0, 0, 1),
+    "right": (0, 1, 0, -1, 0, 1, 0, 0, 1),
+}
+
+# RandR rotation of the panel CRTC for each display orientation
+RANDR_ROTATIONS = {"normal": 1, "left": 2, "inverted": 4, "right": 8}
+RANDR_REFLECTIONS = 16 | 32
+
+# Names of the RandR outputs of built-in panels start with one of these
+PANEL_OUTPUTS = ("eDP", "LVDS", "DSI")
+
+# Device commands are killed after COMMAND_TIMEOUT seconds, and run on at most
+# COMMAND_WORKERS threads
+COMMAND_TIMEOUT = 5.0
+COMMAND_WORKERS = 4
+
+# Names of the backends that carry out the device operations
+BACKENDS = ("x11", "fake")
+
+
+def EVIOCG(nr, length):
+    """Compute the request number of an EVIOCG* ioctl, see <linux/input.h>."""
+    return (2 << 30) | (length << 16) | (ord('E') << 8) | nr
+
+
+class InputDevice(object):
+    """An input device as listed in /proc/bus/input/devices."""
+
+    def __init__(self, name, ids, handlers, bitmaps, sysfs=None):
+        self.name = name
+        self.sysfs = sysfs
+        self.bus = int(ids.get("Bus", "0"), 16)
+        self.vendor = int(ids.get("Vendor", "0"), 16)
+        self.product = int(ids.get("Product", "0"), 16)
+        self.event = None
+        for handler in handlers:
+            if handler.startswith("event"):
+                self.event = handler
+        self.bitmaps = bitmaps
+        self.roles = classify(self)
+
+    def has(self, bitmap, code):
+        return bool(self.bitmaps.get(bitmap, 0) & (1 << code))
+
+    def xName(self, role):
+        """Return the name of the X device for the given role."""
+        if self.vendor == VENDOR_WACOM and role in WACOM_TOOLS:
+            return "{a1} {a2}".format(a1=self.name, a2=WACOM_TOOLS[role])
+        return self.name
+
+
+def parseInputDevices(text):
+    """Return an InputDevice for each entry in /proc/bus/input/devices."""
+    devices = []
+    for block in text.split("\n\n"):
+        name, ids, handlers, bitmaps, sysfs = None, {}, [], {}, None
+        for line in block.splitlines():
+            kind, _, value = line.partition(": ")
+            if kind == "I":
+                ids = dict(field.split("=", 1) for field in value.split())
+            elif kind == "N":
+                name = value.split("=", 1)[1].strip('"')
+            elif kind == "S":
+                sysfs = value.split("=", 1)[1]
+            elif kind == "H":
+                handlers = value.split("=", 1)[1].split()
+            elif kind == "B":
+                key, words = value.split("=", 1)
+                bitmap = 0
+                for word in words.split():
+                    bitmap = (bitmap << LONG_BITS) | int(word, 16)
+                bitmaps[key] = bitmap
+        if name is not None:
+            devices.append(InputDevice(name, ids, handlers, bitmaps, sysfs))
+    return devices
+
+
+def classify(device):
+    """Return the set of roles of an input device by capability and vendor."""
+    roles = set()
+    if device.has("SW", SW_TABLET_MODE):
+        roles.add(TABLET_SWITCH)
+    absolute = device.has("ABS", ABS_X)
+    if absolute and device.has("KEY", BTN_TOOL_PEN):
+        roles.add(STYLUS)
+        if device.has("KEY", BTN_TOOL_RUBBER):
+            roles.add(ERASER)
+    elif absolute and device.has("KEY", BTN_TOOL_FINGER):
+        if device.has("PROP", INPUT_PROP_DIRECT):
+            roles.add(TOUCHSCREEN)
+        else:
+            roles.add(TOUCHPAD)
+    elif absolute and device.has("KEY", BTN_TOUCH):
+        roles.add(TOUCHSCREEN)
+    elif device.has("REL", REL_X) and device.has("KEY", BTN_LEFT):
+        if (device.has("PROP", INPUT_PROP_POINTING_STICK) or
+           (device.bus, device.vendor, device.product) ==
+           (BUS_I8042, VENDOR_PSMOUSE, PRODUCT_TRACKPOINT)):
+            roles.add(NIPPLE)
+    return roles
+
+
+class DeviceIndex(object):
+    """Input devices by role, discovered once and cached until a hotplug.
+
+    Paths are relative to root, so that a fake /proc/bus/input/devices and
+    /dev/input tree can stand in for the real one. A hotplug shows as a change
+    of the modification time of /dev/input, which costs one stat per lookup,
+    or is reported by calling refresh. Whenever the index is rebuilt,
+    listeners are passed the devices that were added and removed.
+    """
+
+    def __init__(self, root="/"):
+        self.root = root
+        self.stamp = None
+        self.roles = None
+        self.devices = None
+        self.names = {}
+        self.listeners = []
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def stat(self):
+        try:
+            return os.stat(self.path("dev", "input")).st_mtime
+        except OSError:
+            return None
+
+    def refresh(self):
+        """Read the input devices again.
+
+        The devices present at the first read are not passed to the listeners
+        as added.
+        """
+        self.stamp = self.stat()
+        with open(self.path("proc", "bus", "input", "devices")) as f:
+            devices = parseInputDevices(f.read())
+        # A device is told apart by its sysfs path, which is new each time it
+        # is plugged in
+        def key(device):
+            return (device.sysfs, device.name, device.event)
+        first = self.devices is None
+        keys = set(key(device) for device in devices)
+        previous = set(key(device) for device in self.devices or [])
+        added = [device for device in devices if key(device) not in previous]
+        removed = [device for device in self.devices or []
+                   if key(device) not in keys]
+        self.devices = devices
+        self.roles = {}
+        for device in devices:
+            for role in device.roles:
+                self.roles.setdefault(role, []).append(device)
+        for device in added:
+            for role in device.roles:
+                LOGGER.info("found {a1}: {a2}".format(a1=role, a2=device.name))
+        for device in removed:
+            for role in device.roles:
+                LOGGER.info("lost {a1}: {a2}".format(a1=role, a2=device.name))
+        if first:
+            added = []
+        for listener in self.listeners:
+            listener(added, removed)
+
+    def lookup(self, role):
+        """Return the input devices that have the given role."""
+        if self.roles is None or self.stat() != self.stamp:
+            self.refresh()
+        return self.roles.get(role, [])
+
+    def xNames(self, role):
+        """Return the names of the X devices that have the given role, those
+        set in names, if any, or those of the detected devices."""
+        if role in self.names:
+            return list(self.names[role])
+        return [device.xName(role) for device in self.lookup(role)]
+
+    def resolve(self, operations):
+        """Expand operations on device roles to operations on X devices."""
+        resolved = []
+        for operation in operations:
+            if operation[0] == "rotate":
+                resolved.append(operation)
+                continue
+            names = self.xNames(operation[1])
+            if not names and operation[1] not in PENS:
+                LOGGER.warning("no {a1} found".format(a1=operation[1]))
+            for name in names:
+                resolved.append((operation[0], name) + operation[2:])
+        return resolved
+
+    def node(self, role):
+        for device in self.lookup(role):
+            if device.event is not None:
+                return self.path("dev", "input", device.event)
+        return None
+
+
+def queryState(fd, nr, maximum, codes):
+    """Return the subset of codes that are set in the state bitmap returned by
+    the EVIOCG* ioctl nr on an evdev fd.
+
+    Returns None if fd does not support the query (a file or pipe replaying a
+    recording, for instance).
+    """
+    length = maximum // 8 + 1
+    try:
+        state = bytearray(fcntl.ioctl(fd, EVIOCG(nr, length),
+                                      b"\0" * length))
+    except (IOError, OSError):
+        return None
+    return set(code for code in codes
+               if state[code // 8] & (1 << (code % 8)))
+
+
+def queryKeys(fd, codes):
+    """Return the subset of the key codes currently held down on an evdev fd,
+    or None, see queryState."""
+    return queryState(fd, 0x18, KEY_MAX, codes)
+
+
+def querySwitches(fd, codes):
+    """Return the subset of the switch codes currently set on an evdev fd, or
+    None, see queryState."""
+    return queryState(fd, 0x1b, SW_MAX, codes)
+
+
+class InputEventReader(object):
+    """Reader of input_event structs from a non-blocking evdev node.
+
+    A file or pipe holding a recorded event stream can be read in place of
+    /dev/input/eventN.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = b""
+
+    def read(self):
+        """Return (type, code, value) of each complete event available.
+
+        Returns None at end of file, or when the device has gone away.
+        """
+        try:
+            data = os.read(self.fd, INPUT_EVENT.size * 64)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            elif e.errno == errno.ENODEV:
+                return None
+            raise
+        if not data:
+            return None
+        self.buf += data
+        end = len(self.buf) - len(self.buf) % INPUT_EVENT.size
+        events = [INPUT_EVENT.unpack_from(self.buf, offset)[2:]
+                  for offset in range(0, end, INPUT_EVENT.size)]
+        self.buf = self.buf[end:]
+        return events
+
+
+class ProximityPoller(object):
+    """Polls the proximity of an X pointer device with xinput query-state.
+
+    Reading the evdev node of a stylus needs root or membership of the input
+    group, while any X client may query the device. Each query runs on a
+    thread of its own, and callback is called on the loop thread with "in" or
+    "out" whenever one succeeds.
+    """
+
+    proximity = re.compile(r"Proximity=(\w+)")
+
+    def __init__(self, loop, device, callback,
+                 interval=PROXIMITY_POLL_INTERVAL):
+        self.loop = loop
+        self.device = device
+        self.callback = callback
+        self.interval = interval
+        self.timer = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.spawn()
+
+    def stop(self):
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def spawn(self):
+        thread = threading.Thread(target=self.query, name="spin-xinput")
+        thread.daemon = True
+        thread.start()
+
+    def query(self):
+        try:
+            process = subprocess.Popen(
+                ["xinput", "query-state", self.device],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True)
+            output, _ = process.communicate()
+        except OSError as e:
+            LOGGER.error("cannot run xinput: {a1}".format(a1=e))
+            output = b""
+        match = self.proximity.search(output.decode("utf-8", "replace"))
+        self.loop.callSoon(self.queried,
+                           match.group(1).lower() if match else None)
+
+    def queried(self, proximity):
+        if not self.running:
+            return
+        if proximity in ("in", "out"):
+            self.callback(proximity)
+        self.timer = self.loop.callLater(self.interval, self.spawn)
+
+
+class AcpiPattern(object):
+    """Match acpid event lines field by field with shell-style wildcards.
+
+    An event line reads e.g. "ibm/hotkey LEN0068:00 00000080 000060c0": device
+    class, bus id, event type and event code. Fields missing from the pattern
+    match anything.
+    """
+
+    def __init__(self, pattern):
+        self.fields = pattern.split()
+
+    def match(self, line):
+        fields = line.split()
+        if len(fields) < len(self.fields):
+            return False
+        return all(fnmatch.fnmatchcase(field, pattern)
+                   for field, pattern in zip(fields, self.fields))
+
+
+class AcpiEventStream(object):
+    """Line-framed reader of the acpid socket.
+
+    Data is buffered until complete lines are available, and each line is
+    dispatched to the handlers whose pattern it matches as soon as it has
+    arrived, however the lines are split across reads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handlers = []
+        self.buf = b""
+
+    def addHandler(self, pattern, callback):
+        self.handlers.append((AcpiPattern(pattern), callback))
+
+    def feed(self, data):
+        self.buf += data
+        lines = self.buf.split(b"\n")
+        self.buf = lines.pop()
+        for line in lines:
+            self.dispatch(line.decode("ascii", "replace"))
+
+    def dispatch(self, line):
+        for pattern, callback in self.handlers:
+            if pattern.match(line):
+                callback(line)
+
+    def connect(self):
+        """Return a new non-blocking connection to acpid."""
+        self.buf = b""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.setblocking(False)
+        return sock
+
+
+def packEvents(events):
+    return b"".join(LOG_EVENT.pack(*event) for event in events)
+
+
+def unpackEvents(data):
+    return [LOG_EVENT.unpack_from(data, offset)
+            for offset in range(0, len(data), LOG_EVENT.size)]
+
+
+class EventLog(object):
+    """Append-only binary log of what the monitors read.
+
+    Each record is written with a single write, so that the log holds every
+    record up to a crash. Once the log has grown beyond limit bytes, it is
+    moved to path.1, replacing the previous one, and a new log is begun; the
+    two take up at most twice limit bytes.
+    """
+
+    def __init__(self, path, clock, limit=LOG_LIMIT):
+        self.path = path
+        self.clock = clock
+        self.limit = limit
+        self.fd = None
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o600)
+        self.size = os.fstat(self.fd).st_size
+        if self.size == 0:
+            self.size = os.write(self.fd, LOG_MAGIC)
+
+    def write(self, source, data):
+        if self.size >= self.limit:
+            self.close()
+            os.rename(self.path, self.path + ".1")
+            self.open()
+        self.size += os.write(self.fd, LOG_RECORD.pack(
+            self.clock(), LOG_SOURCES.index(source), len(data)) + data)
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
+
+def readEventLog(path):
+    """Yield time, source and payload of each record in an event log.
+
+    The log is memory-mapped rather than read, so that logs of millions of
+    events cost no more memory than the records being replayed. A record cut
+    short by a crash ends the log.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(LOG_MAGIC):
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(LOG_MAGIC)] != LOG_MAGIC:
+            raise ValueError("{a1} is not a spin event log".format(a1=path))
+        offset = len(LOG_MAGIC)
+        while offset + LOG_RECORD.size <= len(data):
+            when, source, length = LOG_RECORD.unpack_from(data, offset)
+            offset += LOG_RECORD.size
+            if offset + length > len(data):
+                break
+            yield when, LOG_SOURCES[source], data[offset:offset + length]
+            offset += length
+    finally:
+        data.close()
+
+
+class Replayer(object):
+    """Feed the records of an event log to handlers on the event loop.
+
+    handlers maps each source to a function taking the payload. The records
+    are fed at the recorded pace times speed, or, with a speed of 0, as fast
+    as possible, in slices of at most quantum seconds between which the loop
+    attends to other events. callback is called at the end.
+
+    Pauses longer than gap seconds are cut short, and so are jumps back in
+    time, where spin was started again after a reboot and appended to the
+    same log.
+    """
+
+    def __init__(self, loop, path, handlers, speed=1.0, callback=None,
+                 quantum=0.01, gap=60.0):
+        self.loop = loop
+        self.path = path
+        self.handlers = handlers
+        self.speed = speed
+        self.callback = callback
+        self.quantum = quantum
+        self.gap = gap
+        self.last = None
+        self.records = readEventLog(path)
+        self.count = 0
+        self.start = None
+        self.next = None
+
+    def run(self):
+        self.loop.callSoon(self.step)
+
+    def step(self):
+        deadline = self.loop.clock() + self.quantum
+        while True:
+            if self.next is None:
+                self.next = next(self.records, None)
+                if self.next is None:
+                    if self.callback is not None:
+                        self.callback(self.count)
+                    return
+            when, source, data = self.next
+            if self.speed:
+                if (self.start is None or when < self.last or
+                   when - self.last > self.gap):
+                    self.start = (self.loop.clock(), when)
+                self.last = when
+                delay = (self.start[0] + (when - self.start[1]) / self.speed -
+                         self.loop.clock())
+                if delay > 0:
+                    self.loop.callLater(delay, self.step)
+                    return
+            self.next = None
+            self.count += 1
+            self.handlers[source](data)
+            if self.loop.clock() > deadline:
+                self.loop.callSoon(self.step)
+                return
+
+
+class FileWatcher(object):
+    """Notification of changes to a file through inotify.
+
+    The directory is watched rather than the file itself, so that a file that
+    is replaced by renaming another one over it, as editors do, or that does
+    not exist yet, is followed as well. Until the directory exists, its
+    nearest existing ancestor is watched instead, and the watch moves down as
+    the directories on the way are created, or back up if they are removed.
+    """
+
+    def __init__(self, path):
+        # ctypes is only imported here, as it takes a while to load; the C
+        # library is the one spin runs on
+        import ctypes
+        self.path = path
+        self.name = os.path.basename(path).encode("utf-8")
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(
+            os, "O_CLOEXEC", 0o2000000))
+        if self.fd < 0:
+            raise OSError(self.errno(), "inotify_init1 failed")
+        self.watch = None
+        self.watched = None
+        try:
+            self.arm()
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def nearest(self):
+        """Return the directory of the file, or its nearest existing
+        ancestor."""
+        directory = self.directory
+        while not os.path.isdir(directory):
+            directory = os.path.dirname(directory)
+        return directory
+
+    def arm(self):
+        """Watch the directory of the file, or its nearest ancestor."""
+        if self.watch is not None:
+            # Fails if the directory has gone, which removed the watch
+            self.libc.inotify_rm_watch(self.fd, self.watch)
+            self.watch = None
+        directory = self.nearest()
+        while True:
+            mask = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+            if directory == self.directory:
+                mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                        IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+            watch = self.libc.inotify_add_watch(
+                self.fd, directory.encode("utf-8"), mask)
+            if watch < 0:
+                error = self.errno()
+                raise OSError(error, os.strerror(error), directory)
+            self.watch, self.watched = watch, directory
+            # A directory on the way may have been created in the meantime
+            directory = self.nearest()
+            if directory == self.watched:
+                return
+            self.libc.inotify_rm_watch(self.fd, self.watch)
+
+    def read(self):
+        """Return whether the file has changed since the last call."""
+        changed = moved = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                data = b""
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = INOTIFY_EVENT.unpack_from(data,
+                                                                   offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if watch != self.watch:
+                    # Left over from a watch that has been moved
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    moved = True
+                elif self.watched != self.directory:
+                    below = os.path.join(self.watched,
+                                         name.decode("utf-8", "replace"))
+                    moved = moved or (self.directory + os.sep).startswith(
+                        below + os.sep)
+                else:
+                    changed = changed or name == self.name
+        if moved:
+            watched = self.watched
+            self.arm()
+            # The file may have been written before its directory was
+            # watched, or have gone along with it
+            changed = changed or self.directory in (watched, self.watched)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def murmurHash2(data, seed=0):
+    """Return the 32-bit MurmurHash2 of data, with which libudev hashes the
+    subsystem of a device."""
+    m = 0x5bd1e995
+    h = (seed ^ len(data)) & 0xffffffff
+    end = len(data) & ~3
+    for offset in range(0, end, 4):
+        k = (struct.unpack_from('=I', data, offset)[0] * m) & 0xffffffff
+        k = ((k ^ (k >> 24)) * m) & 0xffffffff
+        h = ((h * m) & 0xffffffff) ^ k
+    tail = bytearray(data[end:])
+    for index in reversed(range(len(tail))):
+        h ^= tail[index] << (8 * index)
+    if tail:
+        h = (h * m) & 0xffffffff
+    h = ((h ^ (h >> 13)) * m) & 0xffffffff
+    return h ^ (h >> 15)
+
+
+def parseUevent(data):
+    """Return the properties of a uevent message from udev or the kernel."""
+    if data.startswith(UDEV_PREFIX):
+        offset, length = UDEV_PROPERTIES.unpack_from(data,
+                                                     UDEV_PROPERTIES_OFFSET)
+        fields = data[offset:offset + length].split(b"\0")
+    else:
+        # The kernel starts with ACTION@DEVPATH
+        fields = data.split(b"\0")[1:]
+    properties = {}
+    for field in fields:
+        key, separator, value = field.decode("utf-8", "replace").partition("=")
+        if separator:
+            properties[key] = value
+    return properties
+
+
+class UeventMonitor(object):
+    """Uevents of some subsystems, as broadcast by udev once it has handled
+    them.
+
+    The messages of other subsystems never wake spin up: as in libudev, a
+    socket filter compares the hash of the subsystem in the header of each
+    message, so that the kernel drops them. With path, the messages are
+    received on a UNIX datagram socket bound there instead, e.g. from a fake
+    udev, through the same filter.
+    """
+
+    def __init__(self, subsystems, path=None):
+        # ctypes is only imported here, as it takes a while to load
+        import ctypes
+        self.subsystems = set(subsystems)
+        self.path = path
+        if path is None:
+            self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                        NETLINK_KOBJECT_UEVENT)
+            self.socket.bind((0, UDEV_MONITOR_GROUP))
+        else:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(path)
+        self.socket.setblocking(False)
+        # Messages without the magic number come from the kernel, and are
+        # passed on to be matched here
+        program = [(BPF_LD_W_ABS, 0, 0, UDEV_MAGIC_OFFSET),
+                   (BPF_JEQ_K, 1, 0, UDEV_MONITOR_MAGIC),
+                   (BPF_RET_K, 0, 0, 0xffffffff)]
+        for subsystem in sorted(self.subsystems):
+            program.extend([
+                (BPF_LD_W_ABS, 0, 0, UDEV_SUBSYSTEM_OFFSET),
+                (BPF_JEQ_K, 0, 1, murmurHash2(subsystem.encode("ascii"))),
+                (BPF_RET_K, 0, 0, 0xffffffff)])
+        program.append((BPF_RET_K, 0, 0, 0))
+        code = ctypes.create_string_buffer(b"".join(
+            SOCK_FILTER.pack(*instruction) for instruction in program))
+        # struct sock_fprog {unsigned short len; struct sock_filter *filter}
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                               struct.pack('HP', len(program),
+                                           ctypes.addressof(code)))
+        self.fd = self.socket.fileno()
+
+    def read(self):
+        """Return the properties of each uevent received.
+
+        If uevents were lost, an empty dict stands in for them.
+        """
+        uevents = []
+        while True:
+            try:
+                data = self.socket.recv(UEVENT_BUFFER)
+            except socket.error as e:
+                if e.args[0] == errno.ENOBUFS:
+                    LOGGER.warning("uevents were lost")
+                    uevents.append({})
+                    continue
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return uevents
+                raise
+            properties = parseUevent(data)
+            if properties.get("SUBSYSTEM") in self.subsystems:
+                uevents.append(properties)
+
+    def close(self):
+        self.socket.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """Single-threaded event loop multiplexing file descriptors and timers.
+
+    All monitors share the thread that runs the loop, and with it the state of
+    spin. Other threads must hand work over with callSoon, which wakes the
+    loop through a pipe; the other methods are for the loop thread only.
+    """
+
+    clock = getattr(time, "monotonic", time.time)
+
+    def __init__(self):
+        self.poll = select.poll()
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.sequence = itertools.count()
+        self.pending = deque()
+        self.running = False
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.addReader(self.wakeupRead, self.drainWakeup)
+
+    def addReader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+        self.updatePoll(fd)
+
+    def removeReader(self, fd):
+        if self.readers.pop(fd, None) is not None:
+            self.updatePoll(fd)
+
+    def addWriter(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+        self.updatePoll(fd)
+
+    def removeWriter(self, fd):
+        if self.writers.pop(fd, None) is not None:
+            self.updatePoll(fd)
+
+    def updatePoll(self, fd):
+        mask = ((select.POLLIN if fd in self.readers else 0) |
+                (select.POLLOUT if fd in self.writers else 0))
+        if mask:
+            self.poll.register(fd, mask)
+        else:
+            self.poll.unregister(fd)
+
+    def callLater(self, delay, callback, *args):
+        """Run callback after delay seconds; return a cancellable Timer."""
+        timer = Timer(self.clock() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+        return timer
+
+    def callSoon(self, callback, *args):
+        """Run callback on the loop thread; safe to call from any thread."""
+        self.pending.append((callback, args))
+        try:
+            os.write(self.wakeupWrite, b"\0")
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drainWakeup(self):
+        try:
+            while os.read(self.wakeupRead, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            LOGGER.exception("error in {a1}".format(
+                a1=getattr(callback, "__name__", callback)))
+
+    def runOnce(self):
+        while self.pending:
+            self.call(*self.pending.popleft())
+        timeout = None
+        while self.timers:
+            when, _, timer = self.timers[0]
+            if timer.cancelled:
+                heapq.heappop(self.timers)
+            elif when <= self.clock():
+                heapq.heappop(self.timers)
+                self.call(timer.callback, timer.args)
+            else:
+                timeout = max(0, int((when - self.clock()) * 1000) + 1)
+                break
+        if self.pending or not self.running:
+            timeout = 0
+        try:
+            ready = self.poll.poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        for fd, event in ready:
+            if event & ~select.POLLOUT and fd in self.readers:
+                self.call(*self.readers[fd])
+            if event & ~select.POLLIN and fd in self.writers:
+                self.call(*self.writers[fd])
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def stop(self):
+        self.running = False
+
+    def start(self):
+        """Run the loop in a background thread."""
+        thread = threading.Thread(target=self.run, name="spin")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class ScanElement(object):
+    """An enabled scan element of an IIO buffer, see sysfs-bus-iio."""
+
+    typeFormat = re.compile(r"([bl]e):([su])(\d+)/(\d+)(?:X(\d+))?>>(\d+)")
+
+    def __init__(self, name, index, type_):
+        self.name = name
+        self.index = index
+        match = self.typeFormat.match(type_)
+        if match is None:
+            raise ValueError("bad scan element type: {a1}".format(a1=type_))
+        endian, sign, realbits, storagebits, repeat, shift = match.groups()
+        self.signed = sign == "s"
+        self.realbits = int(realbits)
+        self.shift = int(shift)
+        self.format = struct.Struct(("<" if endian == "le" else ">") +
+                                    {8: "B", 16: "H", 32: "I", 64: "Q"}[
+                                        int(storagebits)])
+        self.length = self.format.size * int(repeat or 1)
+        self.offset = 0
+
+    def value(self, frame, start):
+        raw = self.format.unpack_from(frame, start + self.offset)[0]
+        raw = (raw >> self.shift) & ((1 << self.realbits) - 1)
+        if self.signed and raw & (1 << (self.realbits - 1)):
+            raw -= 1 << self.realbits
+        return raw
+
+
+class Accelerometer(object):
+    """Buffered reader of an IIO accelerometer.
+
+    Samples are read as frames from the IIO character device, laid out as
+    described by the enabled scan elements, rather than by polling the
+    in_accel_*_raw files. Paths are relative to root, so that a fake sysfs
+    tree and a pipe of frames can stand in for the real device.
+    """
+
+    def __init__(self, root="/", node=None):
+        self.root = root
+        self.node = node
+        self.sysfs = None
+        self.fd = None
+        self.elements = []
+        self.frameSize = 0
+        self.buf = b""
+
+    def find(self):
+        pattern = os.path.join(self.root, "sys", "bus", "iio", "devices",
+                               "iio:device*")
+        for sysfs in sorted(glob.glob(pattern)):
+            if os.path.exists(os.path.join(sysfs, "scan_elements",
+                                           "in_accel_x_en")):
+                return sysfs
+        return None
+
+    def readAttribute(self, *path):
+        with open(os.path.join(self.sysfs, *path)) as f:
+            return f.read().strip()
+
+    def writeAttribute(self, value, *path):
+        with open(os.path.join(self.sysfs, *path), "w") as f:
+            f.write(value)
+
+    def layout(self):
+        """Return the enabled scan elements in order, and the frame size."""
+        elements = []
+        for enable in glob.glob(os.path.join(self.sysfs, "scan_elements",
+                                             "*_en")):
+            name = os.path.basename(enable)[:-len("_en")]
+            if self.readAttribute("scan_elements", name + "_en") == "1":
+                elements.append(ScanElement(
+                    name,
+                    int(self.readAttribute("scan_elements", name + "_index")),
+                    self.readAttribute("scan_elements", name + "_type")))
+        elements.sort(key=lambda element: element.index)
+        size = largest = 0
+        for element in elements:
+            size += -size % element.length
+            element.offset = size
+            size += element.length
+            largest = max(largest, element.length)
+        if largest:
+            size += -size % largest
+        return dict((element.name, element) for element in elements), size
+
+    def open(self):
+        """Set up and enable the buffer; return the fd to read samples from."""
+        self.sysfs = self.find()
+        if self.sysfs is None:
+            raise IOError("no accelerometer found")
+        for axis in "xyz":
+            self.writeAttribute("1", "scan_elements",
+                                "in_accel_{a1}_en".format(a1=axis))
+        if (os.path.exists(os.path.join(self.sysfs, "trigger")) and
+           not self.readAttribute("trigger", "current_trigger")):
+            # Sensor hubs provide a trigger named after the device
+            name = self.readAttribute("name")
+            for trigger in glob.glob(os.path.join(self.sysfs, "..",
+                                                  "trigger*", "name")):
+                with open(trigger) as f:
+                    triggerName = f.read().strip()
+                if triggerName.startswith(name):
+                    self.writeAttribute(triggerName,
+                                        "trigger", "current_trigger")
+                    break
+        self.elements, self.frameSize = self.layout()
+        self.writeAttribute("16", "buffer", "length")
+        self.writeAttribute("1", "buffer", "enable")
+        node = self.node or os.path.join(self.root, "dev",
+                                         os.path.basename(self.sysfs))
+        self.fd = os.open(node, os.O_RDONLY | os.O_NONBLOCK)
+        self.buf = b""
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+        try:
+            self.writeAttribute("0", "buffer", "enable")
+        except (IOError, OSError):
+            pass
+
+    def read(self):
+        """Return (x, y, z) of each complete frame available.
+
+        Returns None at end of file, or when the device has gone away.
+        """
+        try:
+            data = os.read(self.fd, self.frameSize * 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            elif e.errno == errno.ENODEV:
+                return None
+            raise
+        if not data:
+            return None
+        self.buf += data
+        end = len(self.buf) - len(self.buf) % self.frameSize
+        axes = [self.elements["in_accel_" + axis] for axis in "xyz"]
+        samples = [tuple(axis.value(self.buf, start) for axis in axes)
+                   for start in range(0, end, self.frameSize)]
+        self.buf = self.buf[end:]
+        return samples
+
+
+class AutoRotation(object):
+    """Settle accelerometer samples into display orientations.
+
+    A sample points to the orientation whose bottom edge it is tilted towards,
+    once the tilt exceeds threshold degrees, or threshold plus hysteresis to
+    leave the current orientation; otherwise the orientation is kept. The
+    orientation is passed to callback once it has stayed the same for settle
+    seconds.
+    """
+
+    def __init__(self, loop, callback, threshold=35, hysteresis=10,
+                 settle=0.5):
+        self.loop = loop
+        self.callback = callback
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.settle = settle
+        self.orientation = None
+        self.pending = None
+        self.timer = None
+
+    def orientationOf(self, x, y, z):
+        angles = {
+            "normal": math.atan2(-y, math.hypot(x, z)),
+            "inverted": math.atan2(y, math.hypot(x, z)),
+            "left": math.atan2(x, math.hypot(y, z)),
+            "right": math.atan2(-x, math.hypot(y, z)),
+        }
+        candidate = max(angles, key=angles.get)
+        threshold = self.threshold
+        if self.orientation is not None and candidate != self.orientation:
+            threshold += self.hysteresis
+        if math.degrees(angles[candidate]) > threshold:
+            return candidate
+        return self.orientation
+
+    def feed(self, x, y, z):
+        orientation = self.orientationOf(x, y, z)
+        if orientation == self.pending:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = orientation
+        if orientation != self.orientation:
+            self.timer = self.loop.callLater(self.settle, self.settleDown)
+
+    def settleDown(self):
+        self.timer = None
+        self.orientation = self.pending
+        self.callback(self.orientation)
+
+
+class ModeSwitch(object):
+    """Debounce laptop/tablet triggers into mode transitions.
+
+    Each trigger toggles the mode the device is heading for, unless it comes
+    within duplicate seconds of the previous one, in which case it is taken to
+    report the same flip. The mode is passed to callback once no trigger has
+    arrived for settle seconds, and only if it differs from the current one,
+    so that a burst of hinge flips ends in at most one transition. Triggers
+    that do not end in a transition are counted as suppressed.
+    """
+
+    def __init__(self, loop, callback, mode="laptop", settle=0.3,
+                 duplicate=0.05):
+        self.loop = loop
+        self.callback = callback
+        self.settle = settle
+        self.duplicate = duplicate
+        self.mode = mode
+        self.pending = mode
+        self.triggers = 0
+        self.suppressed = 0
+        self.last = None
+        self.timer = None
+
+    def toggle(self):
+        now = self.loop.clock()
+        duplicate = self.last is not None and now - self.last < self.duplicate
+        self.last = now
+        if duplicate:
+            self.suppressed += 1
+            return
+        self.request("tablet" if self.pending == "laptop" else "laptop")
+
+    def request(self, mode):
+        """Head for mode, superseding any transition not made yet."""
+        self.triggers += 1
+        self.pending = mode
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.callLater(self.settle, self.settleDown)
+
+    def settleDown(self):
+        self.timer = None
+        changed = self.pending != self.mode
+        self.suppressed += self.triggers - (1 if changed else 0)
+        self.triggers = 0
+        if changed:
+            self.mode = self.pending
+            self.callback(self.mode)
+
+    def reset(self, mode):
+        """Take mode as the current one, dropping any pending transition."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.suppressed += self.triggers
+        self.triggers = 0
+        self.mode = self.pending = mode
+
+
+class ControlClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b""
+        self.outbuf = b""
+        self.subscribed = False
+        self.closed = False
+        # A slot for the response to each request, in the order of the
+        # requests, holding None until the response is ready
+        self.responses = deque()
+
+
+class ControlServer(object):
+    """UNIX domain control socket of a running spin.
+
+    Each request is a line such as "rotate left", answered by a line holding a
+    JSON object. handler is passed each request and a function to pass the
+    response to, now or later; the responses are sent in the order of the
+    requests. After "subscribe", the client is also sent the state whenever
+    it changes. Clients are served on the event loop, without blocking; a
+    client that leaves more than maxBuffer bytes of responses unread is
+    closed.
+    """
+
+    maxRequest = 4096
+    maxBuffer = 65536
+
+    def __init__(self, loop, path, handler):
+        self.loop = loop
+        self.path = path
+        self.handler = handler
+        self.sock = None
+        self.clients = {}
+
+    def start(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        else:
+            probe.close()
+            LOGGER.error("{a1} is in use by another spin".format(a1=self.path))
+            return
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.loop.addReader(self.sock.fileno(), self.accept)
+        LOGGER.info("listening on {a1}".format(a1=self.path))
+
+    def stop(self):
+        for client in list(self.clients.values()):
+            self.close(client)
+        if self.sock is not None:
+            self.loop.removeReader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            os.unlink(self.path)
+
+    def accept(self):
+        try:
+            sock, _ = self.sock.accept()
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return
+            raise
+        sock.setblocking(False)
+        client = ControlClient(sock)
+        self.clients[sock.fileno()] = client
+        self.loop.addReader(sock.fileno(), self.receive, client)
+
+    def close(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        fd = client.sock.fileno()
+        self.loop.removeReader(fd)
+        self.loop.removeWriter(fd)
+        client.sock.close()
+        del self.clients[fd]
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return
+            data = b""
+        if not data:
+            self.close(client)
+            return
+        client.inbuf += data
+        lines = client.inbuf.split(b"\n")
+        client.inbuf = lines.pop()
+        for line in lines:
+            if client.closed:
+                return
+            request = line.decode("utf-8", "replace").strip()
+            if request == "subscribe":
+                client.subscribed = True
+                request = "state"
+            self.handler(request, self.replier(client))
+        if len(client.inbuf) > self.maxRequest:
+            self.send(client, {"ok": False, "error": "request too long"})
+            self.close(client)
+
+    def replier(self, client):
+        """Return a function that sends the response to the next request of
+        client, after the responses to the requests before it."""
+        slot = [None]
+        client.responses.append(slot)
+
+        def reply(response):
+            slot[0] = response
+            while client.responses and client.responses[0][0] is not None:
+                self.send(client, client.responses.popleft()[0])
+        return reply
+
+    def send(self, client, message):
+        if client.closed:
+            return
+        if len(client.outbuf) > self.maxBuffer:
+            LOGGER.warning("closing a control client that does not read")
+            self.close(client)
+            return
+        client.outbuf += json.dumps(message, sort_keys=True).encode() + b"\n"
+        self.flush(client)
+
+    def flush(self, client):
+        fd = client.sock.fileno()
+        try:
+            sent = client.sock.send(client.outbuf)
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                self.close(client)
+                return
+            sent = 0
+        client.outbuf = client.outbuf[sent:]
+        if client.outbuf:
+            self.loop.addWriter(fd, self.flush, client)
+        else:
+            self.loop.removeWriter(fd)
+
+    def publish(self, state):
+        """Send state to every subscribed client."""
+        for client in list(self.clients.values()):
+            if client.subscribed:
+                self.send(client, {"ok": True, "state": state})
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms in Prometheus text format.
+
+    Recording a sample is a dictionary update, cheap enough to stay on.
+    Gauges are functions returning (labels, value) pairs, called on export.
+    """
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        histogram = self.histograms[key]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    @staticmethod
+    def sample(name, labels, value):
+        if labels:
+            name += "{" + ",".join('{a1}="{a2}"'.format(a1=k, a2=v)
+                                   for k, v in labels) + "}"
+        if isinstance(value, float):
+            value = repr(value)
+        return "{a1} {a2}".format(a1=name, a2=value)
+
+    def export(self):
+        samples = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            samples.setdefault(name, []).append(
+                self.sample(name, labels, value))
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            counts, total, count = histogram
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(self.sample(name + "_bucket",
+                                         labels + (("le", bound),),
+                                         cumulative))
+            lines.append(self.sample(name + "_sum", labels, total))
+            lines.append(self.sample(name + "_count", labels, count))
+        for name, function in self.gauges.items():
+            samples[name] = [
+                self.sample(name, tuple(sorted(labels.items())), value)
+                for labels, value in function()]
+        text = []
+        for name in sorted(samples):
+            if name in self.descriptions:
+                kind, description = self.descriptions[name]
+                text.append("# HELP {a1} {a2}".format(a1=name, a2=description))
+                text.append("# TYPE {a1} {a2}".format(a1=name, a2=kind))
+            text.extend(samples[name])
+        return "\n".join(text) + "\n"
+
+
+class BackendError(Exception):
+    pass
+
+
+class DeviceState(object):
+    """Display orientation and per-device enabled flag and matrix.
+
+    In a desired state, fields that are None or missing are left alone; in
+    the last applied state, they are unknown.
+    """
+
+    def __init__(self, orientation=None, enabled=None, matrices=None):
+        self.orientation = orientation
+        self.enabled = dict(enabled or {})
+        self.matrices = dict(matrices or {})
+
+    def diff(self, current):
+        """Return the operations that take the current state to this one."""
+        operations = []
+        if (self.orientation is not None and
+           self.orientation != current.orientation):
+            operations.append(("rotate", self.orientation))
+        for device, matrix in sorted(self.matrices.items()):
+            if current.matrices.get(device) != matrix:
+                operations.append(("setMatrix", device, matrix))
+        for device, enabled in sorted(self.enabled.items()):
+            if current.enabled.get(device) != enabled:
+                operations.append(("setEnabled", device, enabled))
+        return operations
+
+    def update(self, other):
+        if other.orientation is not None:
+            self.orientation = other.orientation
+        self.enabled.update(other.enabled)
+        self.matrices.update(other.matrices)
+
+    def forget(self, operation):
+        """Make the field set by an operation unknown, unless it has been set
+        to another value since."""
+        if operation[0] == "rotate":
+            if self.orientation == operation[1]:
+                self.orientation = None
+            return
+        fields = (self.enabled if operation[0] == "setEnabled" else
+                  self.matrices)
+        if fields.get(operation[1]) == operation[2]:
+            del fields[operation[1]]
+
+
+class PolicyError(Exception):
+    pass
+
+
+class Policy(namedtuple("Policy", "names triggers rotations modes settle "
+                                  "duplicate")):
+    """What spin does, compiled from the configuration file.
+
+    names maps roles to the X devices that take them instead of the detected
+    ones, triggers holds an AcpiPattern for each acpid event that signals a
+    change between the laptop and tablet states, rotations holds the
+    DeviceState of each orientation and modes that of each mode; settle and
+    duplicate are passed to ModeSwitch. A policy is never changed: a new
+    configuration makes a new one, which replaces the old one as a whole.
+    """
+    __slots__ = ()
+
+
+def makePolicy(names=None, triggers=ACPI_TRIGGERS, matrices=MATRICES,
+               disabled=DISABLED, settle=0.3, duplicate=0.05):
+    # Display orientation together with the matrix of every pointer device,
+    # so that both change in one batch
+    rotations = dict(
+        (orientation, DeviceState(
+            orientation=orientation,
+            matrices=dict((role, matrix) for role in POINTERS)))
+        for orientation, matrix in matrices.items())
+    modes = dict(
+        (mode, DeviceState(
+            orientation="normal",
+            enabled=dict((role, role not in disabled[mode])
+                         for role in SWITCHABLE),
+            matrices=rotations["normal"].matrices))
+        for mode in ("laptop", "tablet"))
+    return Policy(dict(names or {}),
+                  tuple(AcpiPattern(pattern) for pattern in triggers),
+                  rotations, modes, settle, duplicate)
+
+
+DEFAULT_POLICY = makePolicy()
+
+
+def loadPolicy(path):
+    """Compile the configuration file at path into a Policy.
+
+    Missing sections and options keep their defaults, and so does everything
+    if the file does not exist. Raises PolicyError if it cannot be read or
+    holds anything unknown.
+    """
+    if not os.path.exists(path):
+        return DEFAULT_POLICY
+    try:
+        from configparser import RawConfigParser, Error
+    except ImportError:
+        from ConfigParser import RawConfigParser, Error
+    parser = RawConfigParser()
+    read = getattr(parser, "read_file", None) or parser.readfp
+    try:
+        with open(path) as f:
+            read(f)
+    except (IOError, OSError, Error) as e:
+        raise PolicyError(str(e))
+
+    def words(section, option):
+        return parser.get(section, option).split()
+
+    options = {
+        "devices": SWITCHABLE + PENS,
+        "acpi": ("triggers",),
+        "matrices": tuple(MATRICES),
+        "laptop": ("disable",),
+        "tablet": ("disable",),
+        "debounce": ("settle", "duplicate"),
+    }
+    for section in parser.sections():
+        if section not in options:
+            raise PolicyError("unknown section [{a1}]".format(a1=section))
+        for option in parser.options(section):
+            if option not in options[section]:
+                raise PolicyError("unknown option {a1} in [{a2}]".format(
+                    a1=option, a2=section))
+    kwargs = {}
+    if parser.has_section("devices"):
+        kwargs["names"] = dict(
+            (role, tuple(line.strip() for line in
+                         parser.get("devices", role).splitlines()
+                         if line.strip()))
+            for role in parser.options("devices"))
+    if parser.has_option("acpi", "triggers"):
+        kwargs["triggers"] = [line for line in
+                              parser.get("acpi", "triggers").splitlines()
+                              if line.strip()]
+    matrices = dict(MATRICES)
+    for orientation in (parser.options("matrices")
+                        if parser.has_section("matrices") else ()):
+        try:
+            matrix = tuple(float(value) for value in
+                           words("matrices", orientation))
+        except ValueError:
+            matrix = ()
+        if len(matrix) != 9:
+            raise PolicyError("the {a1} matrix needs 9 numbers".format(
+                a1=orientation))
+        matrices[orientation] = matrix
+    kwargs["matrices"] = matrices
+    disabled = dict(DISABLED)
+    for mode in ("laptop", "tablet"):
+        if parser.has_option(mode, "disable"):
+            disabled[mode] = tuple(words(mode, "disable"))
+            for role in disabled[mode]:
+                if role not in SWITCHABLE:
+                    raise PolicyError("cannot disable {a1}".format(a1=role))
+    kwargs["disabled"] = disabled
+    for option in ("settle", "duplicate"):
+        if parser.has_option("debounce", option):
+            try:
+                kwargs[option] = parser.getfloat("debounce", option)
+            except ValueError:
+                raise PolicyError("{a1} must be a number of seconds".format(
+                    a1=option))
+    return makePolicy(**kwargs)
+
+
+class CommandResult(namedtuple("CommandResult",
+                               "args status stderr duration operation")):
+    """Outcome of a device command, or of a request standing in for one.
+
+    status is the exit status, or None if the command timed out or could not
+    be started; stderr is what it wrote to its standard error, and duration
+    the time it took in seconds. operation is the operation carried out, if
+    any.
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def describe(self):
+        if self.status is None:
+            outcome = "failed"
+        else:
+            outcome = "exited with status {a1}".format(a1=self.status)
+        text = "{a1} {a2} after {a3:.1f} ms".format(
+            a1=" ".join(self.args), a2=outcome, a3=self.duration * 1000)
+        if self.stderr:
+            text += ": " + self.stderr
+        return text
+
+
+def runProcess(args, timeout=COMMAND_TIMEOUT, operation=None):
+    """Run a command without a shell and return its CommandResult.
+
+    The command runs in a session of its own, which is killed, along with any
+    children of the command, if it has not finished after timeout seconds.
+    """
+    start = EventLoop.clock()
+    if sys.version_info >= (3, 2):
+        session = {"start_new_session": True}
+    else:
+        session = {"preexec_fn": os.setsid}
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True,
+                                   **session)
+    except OSError as e:
+        return CommandResult(tuple(args), None, str(e),
+                             EventLoop.clock() - start, operation)
+    expired = []
+
+    def kill():
+        expired.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        _, stderr = process.communicate()
+    finally:
+        timer.cancel()
+    stderr = stderr.decode("utf-8", "replace").strip()
+    status = process.returncode
+    if expired:
+        status = None
+        stderr = "killed after {a1} s".format(a1=timeout)
+    return CommandResult(tuple(args), status, stderr,
+                         EventLoop.clock() - start, operation)
+
+
+class Executor(object):
+    """Bounded pool of worker threads running jobs in lanes.
+
+    Jobs in the same lane, such as the commands for one device, run one after
+    the other in the order they were submitted; jobs in different lanes run
+    concurrently, on at most workers threads, which are started as needed.
+    """
+
+    def __init__(self, workers=COMMAND_WORKERS):
+        self.workers = workers
+        self.threads = 0
+        self.idle = 0
+        # Lanes with jobs queued or running, and those ready to be picked up
+        self.lanes = {}
+        self.ready = deque()
+        self.condition = threading.Condition()
+
+    def submit(self, lane, function, *args):
+        """Run function with args in lane, after the jobs before it."""
+        with self.condition:
+            if lane in self.lanes:
+                self.lanes[lane].append((function, args))
+                return
+            self.lanes[lane] = deque([(function, args)])
+            self.ready.append(lane)
+            # Each idle worker picks up one of the ready lanes; a lane beyond
+            # them needs a worker of its own
+            if len(self.ready) <= self.idle:
+                self.condition.notify()
+                return
+            if self.threads >= self.workers:
+                return
+            self.threads += 1
+        thread = threading.Thread(target=self.work, name="spin-worker")
+        thread.daemon = True
+        thread.start()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.idle += 1
+                    self.condition.wait()
+                    self.idle -= 1
+                lane = self.ready.popleft()
+                function, args = self.lanes[lane].popleft()
+            try:
+                function(*args)
+            except Exception:
+                LOGGER.exception("error in {a1}".format(
+                    a1=getattr(function, "__name__", function)))
+            with self.condition:
+                if self.lanes[lane]:
+                    self.ready.append(lane)
+                else:
+                    del self.lanes[lane]
+
+
+class Batch(object):
+    """Results of a batch of operations carried out in several parts.
+
+    callback is passed the results of every part once the last one is added.
+    """
+
+    def __init__(self, parts, callback):
+        self.parts = parts
+        self.callback = callback
+        self.results = []
+        self.lock = threading.Lock()
+
+    def add(self, results):
+        with self.lock:
+            self.results.extend(results)
+            self.parts -= 1
+            if self.parts:
+                return
+        self.callback(self.results)
+
+
+class Backend(object):
+    """Carries out the operations on the display and input devices.
+
+    The operations are tuples as returned by DeviceState.diff, with device
+    roles resolved to device names by DeviceIndex.resolve: ("rotate",
+    orientation), ("setEnabled", device, enabled) and ("setMatrix", device,
+    matrix). Subclasses implement submit, and invalidate if they cache
+    anything about the devices.
+    """
+
+    def invalidate(self):
+        """Forget what is known about the devices, which have changed."""
+        pass
+
+    def submit(self, operations, callback):
+        """Carry out a batch of operations without blocking, and pass the
+        CommandResult of each to callback, on any thread."""
+        raise NotImplementedError
+
+    def apply(self, operations):
+        """Carry out a batch of operations and wait for it.
+
+        Failures are logged; return whether every operation succeeded.
+        """
+        done = threading.Event()
+        results = []
+
+        def finished(batch):
+            results.extend(batch)
+            done.set()
+        self.submit(operations, finished)
+        done.wait()
+        for result in results:
+            if not result.ok:
+                LOGGER.error(result.describe())
+        return all(result.ok for result in results)
+
+
+class FakeBackend(Backend):
+    """Backend that changes nothing but its own record of the display and
+    devices, so that spin can run without an X server.
+
+    Each batch is recorded in batches, with the time it was carried out, and
+    the orientation and the enabled flag and matrix of each device are kept.
+    Operations on devices in failing fail.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or EventLoop.clock
+        self.batches = []
+        self.orientation = None
+        self.enabled = {}
+        self.matrices = {}
+        self.failing = set()
+        self.condition = threading.Condition()
+
+    def submit(self, operations, callback):
+        results = []
+        with self.condition:
+            for operation in operations:
+                if operation[0] != "rotate" and operation[1] in self.failing:
+                    status, error = 1, "failing"
+                else:
+                    status, error = 0, ""
+                    if operation[0] == "rotate":
+                        self.orientation = operation[1]
+                    elif operation[0] == "setEnabled":
+                        self.enabled[operation[1]] = operation[2]
+                    elif operation[0] == "setMatrix":
+                        self.matrices[operation[1]] = operation[2]
+                results.append(CommandResult(
+                    tuple(str(value) for value in operation), status, error,
+                    0.0, operation))
+            if operations:
+                self.batches.append((self.clock(), list(operations)))
+                self.condition.notify_all()
+        callback(results)
+
+    def wait(self, count, timeout=10.0):
+        """Wait until count batches have been carried out, and return the last
+        of them."""
+        with self.condition:
+            deadline = self.clock() + timeout
+            while len(self.batches) < count:
+                if self.clock() > deadline:
+                    raise BackendError("no batch within {a1} s".format(
+                        a1=timeout))
+                self.condition.wait(deadline - self.clock())
+            return self.batches[count - 1]
+
+
+class XCommandBackend(Backend):
+    """Device actions through the xrandr and xinput command line tools."""
+
+    def __init__(self, executor=None, timeout=COMMAND_TIMEOUT):
+        self.executor = executor or Executor()
+        self.timeout = timeout
+
+    def command(self, operation):
+        name, args = operation[0], operation[1:]
+        if name == "rotate":
+            return ["xrandr", "-o", args[0]]
+        elif name == "setEnabled":
+            return ["xinput", "enable" if args[1] else "disable", args[0]]
+        elif name == "setMatrix":
+            return (["xinput", "set-prop", args[0],
+                     "Coordinate Transformation Matrix"] +
+                    [str(value) for value in args[1]])
+        raise ValueError("unknown operation: {a1}".format(a1=name))
+
+    def submit(self, operations, callback):
+        """Carry out a batch of operations, as returned by DeviceState.diff,
+        on the worker threads.
+
+        The commands for the display and for each device run one after the
+        other, after those of earlier batches, until one of them fails; the
+        commands for different targets run concurrently. callback is called
+        on a worker thread with the CommandResult of each command run.
+        """
+        targets, commands = [], {}
+        for operation in operations:
+            target = None if operation[0] == "rotate" else operation[1]
+            if target not in commands:
+                targets.append(target)
+                commands[target] = []
+            commands[target].append(operation)
+        if not targets:
+            callback([])
+            return
+        batch = Batch(len(targets), callback)
+        for target in targets:
+            self.executor.submit(target, self.run, commands[target], batch)
+
+    def run(self, operations, batch):
+        results = []
+        for operation in operations:
+            results.append(runProcess(self.command(operation), self.timeout,
+                                      operation))
+            if not results[-1].ok:
+                break
+        batch.add(results)
+
+
+def importXlib():
+    """Import python-xlib, or raise BackendError if it is not installed.
+
+    It is only imported once an X connection is made, so that a command passed
+    to a running spin, or carried out by the fake backend, does not load it.
+    """
+    global X, Xatom, xerror, Display, randr, xinput
+    try:
+        from Xlib import X, Xatom
+        from Xlib import error as xerror
+        from Xlib.display import Display
+        from Xlib.ext import randr, xinput
+    except ImportError:
+        raise BackendError("python-xlib is not installed")
+
+
+class RandrScreen(object):
+    """The built-in panel of an X screen, rotated by setting its CRTC.
+
+    The screen resources are read with GetScreenResourcesCurrent, which, unlike
+    the GetScreenResources of xrandr, does not make the X server probe the
+    outputs. They are cached until a RandR notification shows a change that
+    was not made here, so that a rotation costs a single round-trip.
+    """
+
+    def __init__(self, display):
+        self.display = display
+        screen = display.screen()
+        self.root = screen.root
+        self.millimeters = (float(screen.width_in_mms) /
+                            screen.width_in_pixels,
+                            float(screen.height_in_mms) /
+                            screen.height_in_pixels)
+        self.timestamp = None
+        self.resources = None
+        self.root.xrandr_select_input(randr.RRScreenChangeNotifyMask |
+                                      randr.RRCrtcChangeNotifyMask |
+                                      randr.RROutputChangeNotifyMask)
+
+    def invalidate(self):
+        self.resources = None
+
+    def processEvents(self):
+        """Drop the cached resources if another client changed them."""
+        while self.display.pending_events():
+            event = self.display.next_event()
+            if hasattr(event, "width_in_pixels"):
+                self.size = (event.width_in_pixels, event.height_in_pixels)
+            if getattr(event, "timestamp", None) != self.timestamp:
+                self.invalidate()
+
+    def refresh(self):
+        resources = self.root.xrandr_get_screen_resources_current()
+        modes = dict((mode.id, mode) for mode in resources.modes)
+        self.crtcs = {}
+        for crtc in resources.crtcs:
+            info = self.display.xrandr_get_crtc_info(
+                crtc, resources.config_timestamp)
+            self.crtcs[crtc] = {
+                "x": info.x, "y": info.y, "width": info.width,
+                "height": info.height, "mode": info.mode,
+                "rotation": info.rotation,
+                "possibleRotations": info.possible_rotations,
+                "outputs": list(info.outputs)}
+        active = []
+        self.panel = None
+        for output in resources.outputs:
+            info = self.display.xrandr_get_output_info(
+                output, resources.config_timestamp)
+            if info.crtc:
+                active.append(info.crtc)
+                if info.name.startswith(PANEL_OUTPUTS):
+                    self.panel = info.crtc
+        if self.panel is None and len(active) == 1:
+            self.panel = active[0]
+        if self.panel is None:
+            raise BackendError("no built-in panel among the RandR outputs")
+        mode = modes[self.crtcs[self.panel]["mode"]]
+        self.panelSize = (mode.width, mode.height)
+        geometry = self.root.get_geometry()
+        self.size = (geometry.width, geometry.height)
+        self.resources = resources
+
+    def setScreenSize(self, size):
+        self.root.xrandr_set_screen_size(
+            size[0], size[1], int(round(size[0] * self.millimeters[0])),
+            int(round(size[1] * self.millimeters[1])))
+        self.size = size
+
+    def setRotation(self, orientation):
+        """Rotate the panel CRTC and return the status of SetCrtcConfig.
+
+        The screen is grown beforehand to hold the rotated panel, and shrunk
+        afterwards to the bounding box of the CRTCs.
+        """
+        crtc = self.crtcs[self.panel]
+        rotation = RANDR_ROTATIONS[orientation]
+        if not crtc["possibleRotations"] & rotation:
+            raise BackendError("the panel cannot be rotated {a1}".format(
+                a1=orientation))
+        rotation |= crtc["rotation"] & RANDR_REFLECTIONS
+        width, height = self.panelSize
+        if orientation in ("left", "right"):
+            width, height = height, width
+        corners = [(crtc["x"] + width, crtc["y"] + height)]
+        corners.extend((other["x"] + other["width"],
+                        other["y"] + other["height"])
+                       for key, other in self.crtcs.items()
+                       if other["mode"] and key != self.panel)
+        size = (max(x for x, _ in corners), max(y for _, y in corners))
+        union = (max(size[0], self.size[0]), max(size[1], self.size[1]))
+        if union != self.size:
+            self.setScreenSize(union)
+        reply = self.display.xrandr_set_crtc_config(
+            self.panel, self.resources.config_timestamp, crtc["x"],
+            crtc["y"], crtc["mode"], rotation, crtc["outputs"])
+        if reply.status == randr.SetConfigSuccess:
+            self.timestamp = reply.new_timestamp
+            crtc.update(rotation=rotation, width=width, height=height)
+            if size != self.size:
+                self.setScreenSize(size)
+        return reply.status
+
+    def rotate(self, orientation):
+        """Rotate the panel, return whether it succeeded."""
+        try:
+            self.processEvents()
+            if self.resources is None:
+                self.refresh()
+            status = self.setRotation(orientation)
+            if status == randr.SetConfigInvalidConfigTime:
+                # The outputs changed before the notification arrived
+                self.refresh()
+                status = self.setRotation(orientation)
+        except xerror.XError as e:
+            self.invalidate()
+            raise BackendError("cannot rotate the panel: {a1}".format(a1=e))
+        return status == randr.SetConfigSuccess
+
+
+class XInputBackend(XCommandBackend):
+    """Device actions as XInput and RandR requests on a persistent X
+    connection.
+
+    Device IDs and property atoms are looked up once and cached, so that
+    enabling a device or setting its matrix costs a single round-trip. The
+    display is rotated through RandrScreen, or by xrandr if the X server lacks
+    RandR 1.3 or the built-in panel cannot be told apart.
+
+    The connection is only used from the lane of the backend on the executor,
+    so that the requests of one batch go out after those of the previous one.
+    A request cannot be cancelled, so an X server that does not answer holds
+    up the lane, but not the caller. A batch that fails on the connection
+    closes it, and the next batch connects again, falling back to xinput and
+    xrandr while that fails, such as while the X server restarts.
+    """
+
+    def __init__(self, executor=None, timeout=COMMAND_TIMEOUT):
+        XCommandBackend.__init__(self, executor, timeout)
+        importXlib()
+        self.display = None
+        self.screen = None
+        self.deviceIds = {}
+        self.errors = []
+        self.connect()
+
+    def connect(self):
+        if self.display is not None:
+            return
+        try:
+            self.display = Display()
+        except xerror.DisplayError as e:
+            raise BackendError(str(e))
+        try:
+            self.setUp()
+        except Exception as e:
+            self.disconnect()
+            raise BackendError(str(e) or e.__class__.__name__)
+
+    def setUp(self):
+        if not self.display.has_extension(xinput.extname):
+            raise BackendError("X server lacks the XInput extension")
+        self.display.set_error_handler(self.onError)
+        self.deviceIds = {}
+        self.atomEnabled = self.display.intern_atom("Device Enabled")
+        self.atomMatrix = self.display.intern_atom(
+            "Coordinate Transformation Matrix")
+        self.atomFloat = self.display.intern_atom("FLOAT")
+        self.screen = None
+        if self.display.has_extension(randr.extname):
+            version = self.display.xrandr_query_version()
+            if (version.major_version, version.minor_version) >= (1, 3):
+                self.screen = RandrScreen(self.display)
+
+    def disconnect(self):
+        """Close the connection, which may be lost already, so that the next
+        batch connects again."""
+        if self.display is None:
+            return
+        try:
+            self.display.close()
+        except Exception:
+            pass
+        self.display = None
+        self.deviceIds = {}
+        self.screen = None
+
+    def invalidate(self):
+        self.executor.submit(self, self.forgetDevices)
+
+    def forgetDevices(self):
+        self.deviceIds = {}
+        # A dock may have brought outputs along with the input devices
+        if self.screen is not None:
+            self.screen.invalidate()
+
+    def onError(self, error, request):
+        self.errors.append(str(error))
+
+    def deviceId(self, device):
+        self.connect()
+        if device not in self.deviceIds:
+            devices = self.display.xinput_query_device(xinput.AllDevices)
+            self.deviceIds = dict((info.name, info.deviceid)
+                                  for info in devices.devices)
+        if device not in self.deviceIds:
+            raise BackendError("no such device: {a1}".format(a1=device))
+        return self.deviceIds[device]
+
+    def changeProperty(self, device, prop, type_, value):
+        self.display.xinput_change_device_property(
+            self.deviceId(device), prop, type_, X.PropModeReplace, value)
+
+    def submit(self, operations, callback):
+        """Carry out a batch of operations as requests on the connection,
+        waiting for them in one round-trip.
+
+        Without RandR, the display is rotated by xrandr while the requests
+        are sent.
+        """
+        commands = []
+        if self.screen is None:
+            commands = [op for op in operations if op[0] == "rotate"]
+            operations = [op for op in operations if op[0] != "rotate"]
+        if not operations:
+            XCommandBackend.submit(self, commands, callback)
+            return
+        batch = Batch(2 if commands else 1, callback)
+        if commands:
+            XCommandBackend.submit(self, commands, batch.add)
+        self.executor.submit(self, self.send, operations, batch)
+
+    def send(self, operations, batch):
+        try:
+            self.connect()
+        except BackendError as e:
+            # Such as while the X server restarts; try again next batch
+            LOGGER.warning("{a1}, using xinput commands".format(a1=e))
+            XCommandBackend.submit(self, operations, batch.add)
+            return
+        start = EventLoop.clock()
+        try:
+            results = self.request(operations, start)
+        except Exception as e:
+            # Such as a lost connection; the batch has to end regardless, and
+            # the next one connects again
+            LOGGER.exception("cannot send the requests")
+            results = [CommandResult(tuple(str(value) for value in operation),
+                                     1, str(e), EventLoop.clock() - start,
+                                     operation)
+                       for operation in operations]
+            self.disconnect()
+        batch.add(results)
+
+    def request(self, operations, start):
+        self.errors = []
+        # The exit status and error of each operation; None for a rotation
+        # that fell back to xrandr, which has a result of its own
+        outcomes = [(0, "")] * len(operations)
+        results = []
+        for index, operation in enumerate(operations):
+            try:
+                if operation[0] == "setEnabled":
+                    self.changeProperty(operation[1], self.atomEnabled,
+                                        Xatom.INTEGER,
+                                        (8, [1 if operation[2] else 0]))
+                elif operation[0] == "setMatrix":
+                    floats = struct.pack("9f", *operation[2])
+                    self.changeProperty(
+                        operation[1], self.atomMatrix, self.atomFloat,
+                        (32, list(struct.unpack("9I", floats))))
+            except BackendError as e:
+                outcomes[index] = (1, str(e))
+        rotated = False
+        for index, operation in enumerate(operations):
+            if operation[0] != "rotate":
+                continue
+            # The reply to SetCrtcConfig comes after the XInput requests
+            # have been carried out, so that there is no need to sync
+            try:
+                rotated = True
+                if self.screen is None:
+                    raise BackendError("X server lacks RandR 1.3")
+                if not self.screen.rotate(operation[1]):
+                    outcomes[index] = (1, "the configuration was refused")
+            except BackendError as e:
+                LOGGER.warning("{a1}, using xrandr".format(a1=e))
+                self.display.sync()
+                results.append(runProcess(self.command(operation),
+                                          self.timeout, operation))
+                outcomes[index] = None
+        if not rotated:
+            self.display.sync()
+        duration = EventLoop.clock() - start
+        for operation, outcome in zip(operations, outcomes):
+            if outcome == (0, "") and self.errors:
+                outcome = (1, "; ".join(self.errors))
+            if outcome is not None:
+                results.append(CommandResult(
+                    tuple(str(value) for value in operation), outcome[0],
+                    outcome[1], duration, operation))
+        return results
+
+
+def defaultControlPath():
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if directory:
+        return os.path.join(directory, "spin.socket")
+    return "/tmp/spin-{a1}.socket".format(a1=os.getuid())
+
+
+def defaultConfigPath():
+    directory = (os.environ.get("XDG_CONFIG_HOME") or
+                 os.path.join(os.path.expanduser("~"), ".config"))
+    return os.path.join(directory, "spin", "spin.conf")
+
+
+def defaultCacheDir():
+    directory = (os.environ.get("XDG_CACHE_HOME") or
+                 os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(directory, "spin")
+
+
+def makeBackend(name="x11"):
+    """Return the backend of the given name, one of BACKENDS; for x11, the
+    fastest one available."""
+    if name == "fake":
+        return FakeBackend()
+    try:
+        return XInputBackend()
+    except BackendError as e:
+        LOGGER.info("using xinput commands: {a1}".format(a1=e))
+        return XCommandBackend()
+
+
+class Interface(object):
+    def __init__(self, args=None, backend=None, devices=None):
+        self.args = args
+        LOGGER.info("running spin")
+        self.backend = backend or makeBackend(self.args["--backend"])
+        self.devices = devices or DeviceIndex()
+        self.devices.listeners.append(self.onDevicesChanged)
+        self.configPath = self.args["--config"] or defaultConfigPath()
+        self.configWatcher = None
+        self.policy = DEFAULT_POLICY
+        self.appliedState = DeviceState()
+        self.loop = EventLoop()
+        self.listeners = []
+        self.notifiedState = None
+        # Prepare metrics
+        self.metrics = Metrics()
+        self.metrics.describe("spin_actions_total", "counter",
+                              "Device actions by result")
+        self.metrics.describe("spin_action_duration_seconds", "histogram",
+                              "Time taken to carry out device actions")
+        self.metrics.describe("spin_operations_total", "counter",
+                              "Display and input device operations")
+        self.metrics.describe("spin_events_total", "counter",
+                              "Events received by source")
+        self.metrics.describe("spin_policy_loads_total", "counter",
+                              "Loads of the configuration file by result")
+        self.metrics.describe("spin_monitor_uptime_seconds", "gauge",
+                              "Time since each monitor was turned on")
+        self.metrics.gauge("spin_monitor_uptime_seconds", self.monitorUptimes)
+        self.monitorStarts = {}
+        # Prepare palm rejection
+        self.stylusProximity = None
+        self.previousStylusProximity = None
+        self.stylusFd = None
+        self.stylusPoller = None
+        self.stylusReader = None
+        self.stylusTools = set()
+        # Prepare device state monitoring
+        self.deviceState = "laptop"
+        self.modeSwitch = ModeSwitch(self.loop, self.onModeChange,
+                                     self.deviceState)
+        self.metrics.describe("spin_mode_transitions_suppressed_total",
+                              "counter", "Laptop/tablet triggers that were "
+                              "debounced or superseded")
+        self.metrics.gauge("spin_mode_transitions_suppressed_total",
+                           lambda: [({}, self.modeSwitch.suppressed)])
+        self.acpiStream = AcpiEventStream(self.args["--acpid"])
+        self.acpiStream.addHandler("", self.onAcpiEvent)
+        self.acpiSocket = None
+        self.switchFd = None
+        self.switchReader = None
+        self.switchMode = None
+        # Prepare hotplug monitoring
+        self.uevents = None
+        self.hotplugTimer = None
+        # Prepare auto-rotation
+        self.accelerometer = Accelerometer(self.devices.root,
+                                           self.args["--accelerometer"])
+        self.autoRotationFilter = AutoRotation(self.loop,
+                                               self.onOrientationChange)
+        # Load the configuration, and reload it whenever it changes
+        self.loadConfig()
+        try:
+            self.configWatcher = FileWatcher(self.configPath)
+        except OSError as e:
+            LOGGER.info("not watching the configuration: {a1}".format(a1=e))
+        else:
+            self.loop.addReader(self.configWatcher.fd, self.configChanged)
+        # Record what the monitors read
+        self.eventLog = None
+        if self.args["--record"]:
+            try:
+                self.eventLog = EventLog(self.args["--record"],
+                                         self.loop.clock)
+            except OSError as e:
+                LOGGER.error("cannot record events: {a1}".format(a1=e))
+        # Enable palm rejection by default
+        self.palmRejectionOn()
+        # Enable device state monitoring by default
+        self.deviceStateMonitoringOn()
+        if self.args["--autorotate"]:
+            self.autoRotationOn()
+        self.hotplugOn()
+        # Listen for control requests: actions, which change the devices and
+        # take a callback, and commands, which switch the monitors
+        self.actions = {
+            "mode laptop": self.engageModeLaptop,
+            "mode tablet": self.engageModeTablet,
+            "rotate normal": self.engageNormal,
+            "rotate inverted": self.engageInverted,
+            "rotate left": self.engageLeft,
+            "rotate right": self.engageRight,
+            "touchscreen on": self.engageTouchscreenOn,
+            "touchscreen off": self.engageTouchscreenOff,
+            "touchpad on": self.engageTouchpadOn,
+            "touchpad off": self.engageTouchpadOff,
+            "nipple on": self.engageNippleOn,
+            "nipple off": self.engageNippleOff,
+        }
+        self.commands = {
+            "palm-rejection on": self.engagePalmRejectionOn,
+            "palm-rejection off": self.engagePalmRejectionOff,
+            "monitoring on": self.engageDeviceStateMonitoringOn,
+            "monitoring off": self.engageDeviceStateMonitoringOff,
+            "auto-rotation on": self.engageAutoRotationOn,
+            "auto-rotation off": self.engageAutoRotationOff,
+        }
+        self.controlServer = ControlServer(
+            self.loop, self.args["--control"] or defaultControlPath(),
+            self.control)
+        self.controlServer.start()
+        self.listeners.append(self.controlServer.publish)
+        if self.args["--metrics"]:
+            self.writeMetricsPeriodically()
+        if self.args["--replay"]:
+            self.replay(self.args["--replay"],
+                        float(self.args["--replay-speed"]))
+        self.window = None
+        if args["--nogui"]:
+            LOGGER.info("non-GUI mode")
+        else:
+            self.createGUI()
+
+    def shutdown(self):
+        LOGGER.info("stopping spin")
+        self.palmRejectionOff()
+        self.deviceStateMonitoringOff()
+        self.autoRotationOff()
+        self.hotplugOff()
+        self.controlServer.stop()
+        if self.eventLog is not None:
+            self.eventLog.close()
+            self.eventLog = None
+        if self.configWatcher is not None:
+            self.loop.removeReader(self.configWatcher.fd)
+            self.configWatcher.close()
+            self.configWatcher = None
+        if self.args["--metrics"]:
+            self.writeMetrics()
+        self.loop.stop()
+
+    def state(self):
+        enabled = self.appliedState.enabled
+        return {
+            "mode": self.deviceState,
+            "orientation": self.appliedState.orientation,
+            "devices": dict((role, enabled.get(role))
+                            for role in (TOUCHSCREEN, TOUCHPAD, NIPPLE)),
+            "stylus": self.stylusProximity,
+            "palmRejection": (self.stylusFd is not None or
+                              self.stylusPoller is not None),
+            "deviceStateMonitoring": (self.acpiSocket is not None or
+                                      self.switchFd is not None),
+            "autoRotation": self.accelerometer.fd is not None,
+        }
+
+    def notify(self):
+        """Pass the state to the listeners if it has changed."""
+        state = self.state()
+        if state != self.notifiedState:
+            self.notifiedState = state
+            for listener in self.listeners:
+                listener(state)
+
+    def monitorUptimes(self):
+        now = self.loop.clock()
+        return [({"monitor": monitor},
+                 now - self.monitorStarts[monitor]
+                 if monitor in self.monitorStarts else 0)
+                for monitor in ("palm_rejection", "device_state",
+                                "auto_rotation", "hotplug")]
+
+    def writeMetrics(self):
+        path = self.args["--metrics"]
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(self.metrics.export())
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            LOGGER.error("cannot write metrics: {a1}".format(a1=e))
+
+    def writeMetricsPeriodically(self):
+        self.writeMetrics()
+        self.loop.callLater(15, self.writeMetricsPeriodically)
+
+    def loadConfig(self):
+        """Compile the configuration file and swap the policy for the new one.
+
+        The monitors keep running, and the new policy takes effect with the
+        next event. If the file is invalid, the current policy is kept.
+        """
+        try:
+            policy = loadPolicy(self.configPath)
+        except PolicyError as e:
+            LOGGER.error("cannot load {a1}: {a2}".format(a1=self.configPath,
+                                                          a2=e))
+            self.metrics.count("spin_policy_loads_total", result="failure")
+            return
+        if policy is DEFAULT_POLICY:
+            LOGGER.info("using the default configuration")
+        else:
+            LOGGER.info("loaded configuration from {a1}".format(
+                a1=self.configPath))
+        self.metrics.count("spin_policy_loads_total", result="success")
+        self.policy = policy
+        self.devices.names = policy.names
+        self.modeSwitch.settle = policy.settle
+        self.modeSwitch.duplicate = policy.duplicate
+
+    def configChanged(self):
+        if self.configWatcher.read():
+            self.loadConfig()
+
+    def replay(self, path, speed=1.0, callback=None):
+        """Feed the records of the event log at path to the monitors."""
+        def finished(count):
+            LOGGER.info("replayed {a1} records".format(a1=count))
+            if callback is not None:
+                callback(count)
+        LOGGER.info("replaying {a1}".format(a1=path))
+        # The lines from acpid are framed apart from those of the live
+        # connection, so that a partial line of one is not joined with the
+        # other; both go to the same handlers
+        acpiStream = AcpiEventStream(self.acpiStream.path)
+        acpiStream.handlers = self.acpiStream.handlers
+        handlers = {
+            "acpi": acpiStream.feed,
+            "stylus": lambda data: self.stylusEvents(unpackEvents(data)),
+            "switch": lambda data: self.switchEvents(unpackEvents(data)),
+        }
+        Replayer(self.loop, path, handlers, speed, finished).run()
+
+    def control(self, request, reply):
+        """Carry out a control request and pass the response to reply.
+
+        An action is answered once the devices have been changed; the
+        response tells whether that succeeded, and lists the roles in which
+        no device was found under "missing".
+        """
+        request = " ".join(request.split())
+        self.metrics.count("spin_events_total", source="control")
+        if request == "metrics":
+            reply({"ok": True, "metrics": self.metrics.export()})
+            return
+        if request in self.actions:
+            def applied(results, missing):
+                response = {"ok": all(result.ok for result in results),
+                            "state": self.state(), "missing": missing}
+                if not response["ok"]:
+                    response["error"] = "; ".join(
+                        result.describe() for result in results
+                        if not result.ok)
+                reply(response)
+            self.actions[request](applied)
+            return
+        if request in self.commands:
+            self.commands[request]()
+        elif request != "state":
+            reply({"ok": False,
+                   "error": "unknown request: {a1}".format(a1=request)})
+            return
+        reply({"ok": True, "state": self.state()})
+
+    def post(self, on, off=None):
+        """Return a slot for the clicked signal of a toggle.
+
+        The slot runs on, or off if given and the toggle has been unchecked,
+        on the event loop, and then shows the state in the window, so that a
+        toggle that did not take effect is set back.
+        """
+        def slot(checked):
+            self.loop.callSoon(on if checked or off is None else off)
+            self.loop.callSoon(
+                lambda: self.window.stateChanged.emit(self.state()))
+        return slot
+
+    def createGUI(self):
+        # Qt is only imported here, so that non-GUI mode never loads it
+        from PyQt4 import QtCore, QtGui
+
+        class Window(QtGui.QWidget):
+            # Emitted on the loop thread whenever the state changes, and
+            # delivered to render on the GUI thread
+            stateChanged = QtCore.pyqtSignal(object)
+
+            def render(self, state):
+                for group, exclusive, buttons in self.groups:
+                    # An exclusive group would keep one toggle checked,
+                    # while the orientation may be unknown
+                    group.setExclusive(False)
+                    for button, checked in buttons:
+                        button.setChecked(checked(state))
+                    group.setExclusive(exclusive)
+
+        window = Window()
+        self.window = window
+        # Toggles by row: text, how to tell from the state whether it is
+        # checked, and the methods to turn it on and off; in exclusive rows,
+        # checking a toggle unchecks the others
+        rows = [
+            ("monitors", False, [
+                ("device state", lambda state: state["deviceStateMonitoring"],
+                 self.engageDeviceStateMonitoringOn,
+                 self.engageDeviceStateMonitoringOff),
+                ("palm rejection", lambda state: state["palmRejection"],
+                 self.engagePalmRejectionOn, self.engagePalmRejectionOff),
+                ("auto-rotation", lambda state: state["autoRotation"],
+                 self.engageAutoRotationOn, self.engageAutoRotationOff)]),
+            ("mode", True, [
+                ("laptop", lambda state: state["mode"] == "laptop",
+                 self.engageModeLaptop, None),
+                ("tablet", lambda state: state["mode"] == "tablet",
+                 self.engageModeTablet, None)]),
+            ("orientation", True, [
+                ("normal", lambda state: state["orientation"] == "normal",
+                 self.engageNormal, None),
+                ("inverted", lambda state: state["orientation"] == "inverted",
+                 self.engageInverted, None),
+                ("left", lambda state: state["orientation"] == "left",
+                 self.engageLeft, None),
+                ("right", lambda state: state["orientation"] == "right",
+                 self.engageRight, None)]),
+            ("devices", False, [
+                ("touchscreen",
+                 lambda state: state["devices"][TOUCHSCREEN] is True,
+                 self.engageTouchscreenOn, self.engageTouchscreenOff),
+                ("touchpad", lambda state: state["devices"][TOUCHPAD] is True,
+                 self.engageTouchpadOn, self.engageTouchpadOff),
+                ("nipple", lambda state: state["devices"][NIPPLE] is True,
+                 self.engageNippleOn, self.engageNippleOff)]),
+        ]
+        window.groups = []
+        grid = QtGui.QGridLayout()
+        for row, (title, exclusive, toggles) in enumerate(rows):
+            grid.addWidget(QtGui.QLabel(title, window), row, 0)
+            group = QtGui.QButtonGroup(window)
+            group.setExclusive(exclusive)
+            buttons = []
+            for column, (text, checked, on, off) in enumerate(toggles):
+                button = QtGui.QPushButton(text, window)
+                button.setCheckable(True)
+                button.setMinimumSize(100, 50)
+                button.clicked[bool].connect(self.post(on, off))
+                group.addButton(button)
+                grid.addWidget(button, row, column + 1)
+                buttons.append((button, checked))
+            window.groups.append((group, exclusive, buttons))
+        window.stateChanged.connect(window.render,
+                                    QtCore.Qt.QueuedConnection)
+        self.listeners.append(window.stateChanged.emit)
+        window.render(self.state())
+        window.setLayout(grid)
+        # window
+        window.setWindowTitle('spin')
+        # set window position
+        #window.move(0, 0)
+        window.move(QtGui.QDesktopWidget().screenGeometry().width(), 0)
+        window.show()
+
+    def engageDeviceStateMonitoringOn(self):
+        self.deviceStateMonitoringOn()
+
+    def engageDeviceStateMonitoringOff(self):
+        self.deviceStateMonitoringOff()
+
+    def engagePalmRejectionOn(self):
+        self.palmRejectionOn()
+
+    def engagePalmRejectionOff(self):
+        self.palmRejectionOff()
+
+    def engageAutoRotationOn(self):
+        self.autoRotationOn()
+
+    def engageAutoRotationOff(self):
+        self.autoRotationOff()
+
+    def engageModeLaptop(self, callback=None):
+        self.engageMode("laptop", callback)
+
+    def engageModeTablet(self, callback=None):
+        self.engageMode("tablet", callback)
+
+    def engageMode(self, mode, callback=None):
+        self.modeSwitch.reset(mode)
+        self.deviceState = mode
+        operations = self.applyState(
+            self.policy.modes[mode], "engageMode" + mode.capitalize(),
+            callback=callback)
+        LOGGER.info("changing to {a1} mode ({a2} operations)".format(
+            a1=mode, a2=len(operations)))
+        if (mode == "tablet" and self.accelerometer.fd is not None and
+           self.autoRotationFilter.orientation):
+            self.onOrientationChange(self.autoRotationFilter.orientation)
+
+    def applyState(self, state, action, force=False, callback=None):
+        """Apply the difference between state and the last applied state.
+
+        With force, every field of state is applied regardless. The operations
+        are carried out by the backend off the loop thread; once they are
+        done, the time taken and the result are recorded in the metrics under
+        the name of action, and failures are logged. A field whose operation
+        failed on any device is unknown from then on, so that it is applied
+        again the next time.
+
+        callback, if any, is called on the loop thread with the results, and
+        the roles of state in which no device was found, once the operations
+        are done, or at once if there are none.
+        """
+        operations = state.diff(DeviceState() if force else self.appliedState)
+        if callback is not None:
+            missing = [role for role in sorted(set(state.enabled) |
+                                               set(state.matrices))
+                       if role not in PENS and not self.devices.xNames(role)]
+            reported = callback
+            callback = lambda results: reported(results, missing)
+        if operations:
+            start = self.loop.clock()
+            targets = [(operation, self.devices.resolve([operation]))
+                       for operation in operations]
+            self.backend.submit(
+                [each for _, resolved in targets for each in resolved],
+                lambda results: self.loop.callSoon(
+                    self.onStateApplied, action, start, results, callback,
+                    targets))
+            for operation in operations:
+                self.metrics.count("spin_operations_total",
+                                   operation=operation[0])
+        else:
+            self.metrics.count("spin_actions_total", action=action,
+                               result="unchanged")
+            if callback is not None:
+                self.loop.callSoon(callback, [])
+        self.appliedState.update(state)
+        self.notify()
+        return operations
+
+    def onStateApplied(self, action, start, results, callback,
+                       targets=()):
+        done = set(result.operation for result in results if result.ok)
+        for operation, resolved in targets:
+            if not all(each in done for each in resolved):
+                self.appliedState.forget(operation)
+        if all(result.ok for result in results):
+            outcome = "success"
+        elif any(result.status is None for result in results):
+            outcome = "timeout"
+        else:
+            outcome = "failure"
+        self.metrics.observe("spin_action_duration_seconds",
+                             self.loop.clock() - start, action=action)
+        self.metrics.count("spin_actions_total", action=action,
+                           result=outcome)
+        for result in results:
+            if not result.ok:
+                LOGGER.error("{a1}: {a2}".format(a1=action,
+                                                 a2=result.describe()))
+        self.notify()
+        if callback is not None:
+            callback(results)
+
+    def engageNormal(self, callback=None):
+        self.rotate("normal", callback)
+
+    def engageInverted(self, callback=None):
+        self.rotate("inverted", callback)
+
+    def engageLeft(self, callback=None):
+        self.rotate("left", callback)
+
+    def engageRight(self, callback=None):
+        self.rotate("right", callback)
+
+    def engageTouchscreenOn(self, callback=None):
+        self.touchscreenOn(callback)
+
+    def engageTouchscreenOff(self, callback=None):
+        self.touchscreenOff(callback)
+
+    def engageTouchpadOn(self, callback=None):
+        self.touchpadOn(callback)
+
+    def engageTouchpadOff(self, callback=None):
+        self.touchpadOff(callback)
+
+    def engageNippleOn(self, callback=None):
+        self.nippleOn(callback)
+
+    def engageNippleOff(self, callback=None):
+        self.nippleOff(callback)
+
+    def deviceStateMonitoring(self):
+        try:
+            data = self.acpiSocket.recv(4096)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return
+            raise
+        if not data:
+            LOGGER.warning("acpid closed the connection")
+            self.deviceStateMonitoringOff()
+            return
+        if self.eventLog is not None:
+            self.eventLog.write("acpi", data)
+        self.acpiStream.feed(data)
+
+    def onAcpiEvent(self, line):
+        self.metrics.count("spin_events_total", source="acpi")
+        if any(pattern.match(line) for pattern in self.policy.triggers):
+            self.onDeviceStateChange(line)
+
+    def onDeviceStateChange(self, acpi_event):
+        LOGGER.info("device state change")
+        self.modeSwitch.toggle()
+
+    def onModeChange(self, mode):
+        LOGGER.info("device state is {a1}".format(a1=mode))
+        self.engageMode(mode)
+
+    def tabletSwitch(self):
+        events = self.switchReader.read()
+        if events is None:
+            LOGGER.info("end of tablet mode switch events")
+            self.deviceStateMonitoringOff()
+            return
+        if self.eventLog is not None:
+            self.eventLog.write("switch", packEvents(events))
+        self.switchEvents(events)
+
+    def switchEvents(self, events):
+        self.metrics.count("spin_events_total", len(events), source="switch")
+        for type_, code, value in events:
+            if type_ == EV_SW and code == SW_TABLET_MODE:
+                self.switchMode = "tablet" if value else "laptop"
+            elif (type_ == EV_SYN and code == SYN_REPORT and
+                  self.switchMode is not None):
+                LOGGER.info("device state change")
+                self.modeSwitch.request(self.switchMode)
+                self.switchMode = None
+
+    def tabletSwitchOn(self):
+        """Follow the tablet mode switch, if there is one, starting from its
+        current state. Return whether it could be opened."""
+        device = self.args["--switch"] or self.devices.node(TABLET_SWITCH)
+        if device is None:
+            return False
+        try:
+            self.switchFd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            LOGGER.error("cannot open tablet mode switch: {a1}".format(a1=e))
+            return False
+        self.switchReader = InputEventReader(self.switchFd)
+        self.switchMode = None
+        switches = querySwitches(self.switchFd, (SW_TABLET_MODE,))
+        if switches is not None:
+            mode = "tablet" if switches else "laptop"
+            if mode != self.deviceState:
+                self.engageMode(mode)
+        self.loop.addReader(self.switchFd, self.tabletSwitch)
+        return True
+
+    def deviceStateMonitoringOn(self):
+        if self.acpiSocket is None and self.switchFd is None:
+            LOGGER.info("changing device state monitoring to on")
+            if not self.tabletSwitchOn():
+                LOGGER.info("no tablet mode switch, using acpid")
+                try:
+                    self.acpiSocket = self.acpiStream.connect()
+                except socket.error as e:
+                    LOGGER.error("cannot connect to acpid: {a1}".format(a1=e))
+                    return
+                self.loop.addReader(self.acpiSocket.fileno(),
+                                    self.deviceStateMonitoring)
+            self.monitorStarts["device_state"] = self.loop.clock()
+            LOGGER.info("device state is {a1}".format(a1=self.deviceState))
+            self.notify()
+
+    def deviceStateMonitoringOff(self):
+        if self.acpiSocket is not None or self.switchFd is not None:
+            LOGGER.info("changing device state monitoring to off")
+            if self.switchFd is not None:
+                self.loop.removeReader(self.switchFd)
+                os.close(self.switchFd)
+                self.switchFd = None
+            else:
+                self.loop.removeReader(self.acpiSocket.fileno())
+                self.acpiSocket.close()
+                self.acpiSocket = None
+            del self.monitorStarts["device_state"]
+            self.notify()
+
+    def palmRejection(self):
+        events = self.stylusReader.read()
+        if events is None:
+            LOGGER.info("end of stylus events")
+            self.palmRejectionOff()
+            return
+        if self.eventLog is not None:
+            self.eventLog.write("stylus", packEvents(events))
+        self.stylusEvents(events)
+
+    def stylusEvents(self, events):
+        self.metrics.count("spin_events_total", len(events), source="stylus")
+        for type_, code, value in events:
+            if type_ == EV_KEY and code in (BTN_TOOL_PEN, BTN_TOOL_RUBBER):
+                if value:
+                    self.stylusTools.add(code)
+                else:
+                    self.stylusTools.discard(code)
+            elif type_ == EV_SYN and code == SYN_REPORT:
+                self.updateStylusProximity(
+                    "in" if self.stylusTools else "out")
+
+    def updateStylusProximity(self, stylusProximity):
+        self.stylusProximity = stylusProximity
+        if (self.stylusProximity == "out" and
+           self.previousStylusProximity != "out"):
+            LOGGER.info("stylus inactive")
+            self.touchscreenOn()
+        elif (self.stylusProximity == "in" and
+              self.previousStylusProximity != "in"):
+            LOGGER.info("stylus active")
+            self.touchscreenOff()
+        self.previousStylusProximity = self.stylusProximity
+
+    def palmRejectionOn(self):
+        if self.stylusFd is None and self.stylusPoller is None:
+            device = self.args["--stylus"] or self.devices.node(STYLUS)
+            if device is None:
+                LOGGER.warning("no stylus found, palm rejection unavailable")
+                return
+            LOGGER.info("changing palm rejection to on")
+            try:
+                self.stylusFd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno in (errno.EACCES, errno.EPERM):
+                    self.pollStylus(e)
+                else:
+                    LOGGER.error("cannot open stylus: {a1}".format(a1=e))
+                return
+            self.stylusReader = InputEventReader(self.stylusFd)
+            self.stylusTools = queryKeys(
+                self.stylusFd, (BTN_TOOL_PEN, BTN_TOOL_RUBBER)) or set()
+            self.updateStylusProximity("in" if self.stylusTools else "out")
+            self.loop.addReader(self.stylusFd, self.palmRejection)
+            self.monitorStarts["palm_rejection"] = self.loop.clock()
+            self.notify()
+
+    def pollStylus(self, error):
+        """Follow the stylus through xinput, as its evdev node cannot be
+        opened for lack of permission."""
+        names = self.devices.xNames(STYLUS)
+        if not names:
+            LOGGER.error("cannot open stylus: {a1}".format(a1=error))
+            return
+        LOGGER.warning("cannot open stylus: {a1}, polling {a2} through "
+                       "xinput instead".format(a1=error, a2=names[0]))
+        self.stylusPoller = ProximityPoller(self.loop, names[0],
+                                            self.updateStylusProximity)
+        self.stylusPoller.start()
+        self.monitorStarts["palm_rejection"] = self.loop.clock()
+        self.notify()
+
+    def palmRejectionOff(self):
+        if self.stylusFd is not None or self.stylusPoller is not None:
+            LOGGER.info("changing palm rejection to off")
+            if self.stylusFd is not None:
+                self.loop.removeReader(self.stylusFd)
+                os.close(self.stylusFd)
+                self.stylusFd = None
+            else:
+                self.stylusPoller.stop()
+                self.stylusPoller = None
+            del self.monitorStarts["palm_rejection"]
+            self.notify()
+
+    def autoRotation(self):
+        samples = self.accelerometer.read()
+        if samples is None:
+            LOGGER.info("end of accelerometer samples")
+            self.autoRotationOff()
+            return
+        self.metrics.count("spin_events_total", len(samples),
+                           source="accelerometer")
+        for x, y, z in samples:
+            self.autoRotationFilter.feed(x, y, z)
+
+    def onOrientationChange(self, orientation):
+        LOGGER.info("device orientation is {a1}".format(a1=orientation))
+        if (self.deviceState == "tablet" and
+           orientation != self.appliedState.orientation):
+            {"normal": self.engageNormal,
+             "inverted": self.engageInverted,
+             "left": self.engageLeft,
+             "right": self.engageRight}[orientation]()
+
+    def autoRotationOn(self):
+        if self.accelerometer.fd is None:
+            LOGGER.info("changing auto-rotation to on")
+            try:
+                fd = self.accelerometer.open()
+            except (IOError, OSError) as e:
+                LOGGER.error("cannot open accelerometer: {a1}".format(a1=e))
+                return
+            self.loop.addReader(fd, self.autoRotation)
+            self.monitorStarts["auto_rotation"] = self.loop.clock()
+            self.notify()
+
+    def autoRotationOff(self):
+        if self.accelerometer.fd is not None:
+            LOGGER.info("changing auto-rotation to off")
+            self.loop.removeReader(self.accelerometer.fd)
+            self.accelerometer.close()
+            del self.monitorStarts["auto_rotation"]
+            self.notify()
+
+    def hotplug(self):
+        uevents = self.uevents.read()
+        if not uevents:
+            return
+        self.metrics.count("spin_events_total", len(uevents), source="uevent")
+        # A dock brings a burst of devices, which X adds in its own time
+        if self.hotplugTimer is not None:
+            self.hotplugTimer.cancel()
+        self.hotplugTimer = self.loop.callLater(HOTPLUG_SETTLE,
+                                                self.rescanDevices)
+
+    def rescanDevices(self):
+        self.hotplugTimer = None
+        self.devices.refresh()
+
+    def onDevicesChanged(self, added, removed):
+        self.backend.invalidate()
+        if added:
+            # The index may be in the middle of a lookup
+            self.loop.callSoon(self.applyToDevices, added)
+
+    def applyToDevices(self, devices):
+        """Bring input devices that were plugged in to the state of the
+        devices in their roles, leaving the others alone."""
+        operations = []
+        for device in devices:
+            for role in sorted(device.roles):
+                name = device.xName(role)
+                if (role in self.devices.names and
+                   name not in self.devices.names[role]):
+                    continue
+                if role in self.appliedState.matrices:
+                    operations.append(("setMatrix", name,
+                                       self.appliedState.matrices[role]))
+                if role in self.appliedState.enabled:
+                    operations.append(("setEnabled", name,
+                                       self.appliedState.enabled[role]))
+        if not operations:
+            return
+        LOGGER.info("applying {a1} operations to new devices".format(
+            a1=len(operations)))
+        start = self.loop.clock()
+        self.backend.submit(operations, lambda results: self.loop.callSoon(
+            self.onStateApplied, "hotplug", start, results, None))
+        for operation in operations:
+            self.metrics.count("spin_operations_total",
+                               operation=operation[0])
+
+    def hotplugOn(self):
+        if self.uevents is None:
+            try:
+                self.uevents = UeventMonitor(HOTPLUG_SUBSYSTEMS,
+                                             self.args["--uevents"])
+            except (IOError, OSError) as e:
+                LOGGER.info("not following hotplugs: {a1}".format(a1=e))
+                return
+            self.loop.addReader(self.uevents.fd, self.hotplug)
+            self.monitorStarts["hotplug"] = self.loop.clock()
+
+    def hotplugOff(self):
+        if self.uevents is not None:
+            self.loop.removeReader(self.uevents.fd)
+            self.uevents.close()
+            self.uevents = None
+            del self.monitorStarts["hotplug"]
+            if self.hotplugTimer is not None:
+                self.hotplugTimer.cancel()
+                self.hotplugTimer = None
+
+    def rotate(self, orientation, callback=None):
+        """Rotate the display and every pointer device in one batch."""
+        LOGGER.info("changing orientation to {a1}".format(a1=orientation))
+        start = self.loop.clock()
+
+        def rotated(results, missing):
+            if all(result.ok for result in results):
+                LOGGER.info("rotated to {a1} in {a2:.1f} ms".format(
+                    a1=orientation, a2=(self.loop.clock() - start) * 1000))
+            if callback is not None:
+                callback(results, missing)
+        self.applyState(self.policy.rotations[orientation],
+                        "rotate" + orientation.capitalize(), force=True,
+                        callback=rotated)
+
+    def touchscreenOn(self, callback=None):
+        LOGGER.info("changing touchscreen to on")
+        self.applyState(DeviceState(enabled={TOUCHSCREEN: True}),
+                        "touchscreenOn", force=True, callback=callback)
+
+    def touchscreenOff(self, callback=None):
+        LOGGER.info("changing touchscreen to off")
+        self.applyState(DeviceState(enabled={TOUCHSCREEN: False}),
+                        "touchscreenOff", force=True, callback=callback)
+
+    def touchpadOn(self, callback=None):
+        LOGGER.info("changing touchpad to on")
+        self.applyState(DeviceState(enabled={TOUCHPAD: True}),
+                        "touchpadOn", force=True, callback=callback)
+
+    def touchpadOff(self, callback=None):
+        LOGGER.info("changing touchpad to off")
+        self.applyState(DeviceState(enabled={TOUCHPAD: False}),
+                        "touchpadOff", force=True, callback=callback)
+
+    def nippleOn(self, callback=None):
+        LOGGER.info("changing nipple to on")
+        self.applyState(DeviceState(enabled={NIPPLE: True}),
+                        "nippleOn", force=True, callback=callback)
+
+    def nippleOff(self, callback=None):
+        LOGGER.info("changing nipple to off")
+        self.applyState(DeviceState(enabled={NIPPLE: False}),
+                        "nippleOff", force=True, callback=callback)
+
+
+def commandOf(args):
+    """Return the control request for the command given in args, if any."""
+    if args["laptop"] or args["tablet"]:
+        return "mode laptop" if args["laptop"] else "mode tablet"
+    if args["rotate"]:
+        for orientation in ("normal", "inverted", "left", "right"):
+            if args[orientation]:
+                return "rotate " + orientation
+    for target in (TOUCHSCREEN, TOUCHPAD, NIPPLE, "palm-rejection",
+                   "monitoring", "auto-rotation"):
+        if args[target]:
+            return target + (" on" if args["on"] else " off")
+    return None
+
+
+def sendRequest(path, request, timeout=2 * COMMAND_TIMEOUT):
+    """Pass request to the spin listening on path and return the response.
+
+    Returns None if no spin is listening. An action is answered once it has
+    been carried out, so timeout leaves room for a batch that times out.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        client.close()
+        return None
+    client.settimeout(timeout)
+    try:
+        client.sendall((request + "\n").encode("utf-8"))
+        response = b""
+        while not response.endswith(b"\n"):
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+    finally:
+        client.close()
+    return json.loads(response.decode("utf-8"))
+
+
+def runCommand(args, command):
+    """Carry out a one-shot command and return the exit status."""
+    try:
+        response = sendRequest(args["--control"] or defaultControlPath(),
+                               command)
+    except (socket.error, ValueError) as e:
+        LOGGER.error("no answer from spin: {a1}".format(a1=e))
+        return 1
+    if response is not None:
+        if not response["ok"]:
+            LOGGER.error(response["error"])
+            return 1
+        for role in response.get("missing", ()):
+            LOGGER.error("no {a1} found".format(a1=role))
+        return 2 if response.get("missing") else 0
+    try:
+        policy = loadPolicy(args["--config"] or defaultConfigPath())
+    except PolicyError as e:
+        LOGGER.error("cannot load the configuration: {a1}".format(a1=e))
+        return 1
+    target, value = command.split()
+    if target == "mode":
+        state = policy.modes[value]
+    elif target == "rotate":
+        state = policy.rotations[value]
+    elif target in (TOUCHSCREEN, TOUCHPAD, NIPPLE):
+        state = DeviceState(enabled={target: value == "on"})
+    else:
+        LOGGER.error("{a1} needs a running spin".format(a1=target))
+        return 3
+    devices = DeviceIndex()
+    devices.names = policy.names
+    operations = state.diff(DeviceState())
+    resolved = devices.resolve(operations)
+    if not makeBackend(args["--backend"]).apply(resolved):
+        return 1
+    if any(not devices.xNames(operation[1]) for operation in operations
+           if operation[0] != "rotate" and operation[1] not in PENS):
+        return 2
+    return 0
+
+
+def main(args):
+    if args["--backend"] not in BACKENDS:
+        LOGGER.error("unknown backend: {a1}".format(a1=args["--backend"]))
+        sys.exit(1)
+    command = commandOf(args)
+    if command is not None:
+        sys.exit(runCommand(args, command))
+    if args["--nogui"]:
+        interface = Interface(args)
+        # kill and systemd stop spin with SIGTERM, which is to clean up like
+        # Ctrl+C; callSoon is safe to call from a signal handler
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame:
+                          interface.loop.callSoon(interface.shutdown))
+        try:
+            interface.loop.run()
+        except KeyboardInterrupt:
+            interface.shutdown()
+    else:
+        from PyQt4 import QtCore, QtGui
+        application = QtGui.QApplication(sys.argv)
+        interface = Interface(args)
+        thread = interface.loop.start()
+        # Close the window on SIGTERM; Python only handles the signal once Qt
+        # runs some Python code, which the timer makes sure of
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: application.quit())
+        timer = QtCore.QTimer()
+        timer.timeout.connect(lambda: None)
+        timer.start(500)
+        status = application.exec_()
+        # The window has been closed
+        interface.loop.callSoon(interface.shutdown)
+        thread.join()
+        sys.exit(status)
+
+
+def parseArguments(doc):
+    """Parse the command line against the usage message doc of spin.py with
+    spin_usage.py, the parser generated by parsergen.py, if it is up to date,
+    and otherwise with docopt."""
+    try:
+        import spin_usage
+    except ImportError:
+        spin_usage = None
+    if spin_usage is not None and spin_usage.DOC == doc:
+        return spin_usage.parse()
+    from docopt import docopt
+    try:
+        return docopt(doc, cache_dir=defaultCacheDir())
+    except TypeError:
+        # docopt from PyPI, which always parses the usage
+        return docopt(doc)